@@ -0,0 +1,176 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from animation import input_pixel_count
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment (0 disables a limit)
+ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', 2))
+ADMISSION_MAX_INFLIGHT_PIXELS = int(os.environ.get('ADMISSION_MAX_INFLIGHT_PIXELS', 64_000_000))
+ADMISSION_MAX_QUEUED_PIXELS = int(os.environ.get('ADMISSION_MAX_QUEUED_PIXELS', 128_000_000))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 60))
+ADMISSION_DEFAULT_RETRY_AFTER = int(os.environ.get('ADMISSION_DEFAULT_RETRY_AFTER', 5))
+
+# Weight of the newest request in the drain rate estimate
+DRAIN_RATE_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be queued or waited too long; carries Retry-After seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def request_cost(input_data):
+    """Decoded pixel count of an upload across its frames, read from headers without decoding"""
+    try:
+        return max(1, input_pixel_count(input_data))
+    except Exception:
+        # Undecodable uploads are rejected soon after admission
+        return 1
+
+
+class AdmissionController:
+    """
+    Concurrency limiter with a bounded FIFO wait queue, both weighted by pixel count
+
+    A request runs once fewer than max_concurrent requests are running and
+    the pixels in flight stay within max_inflight_pixels (a request larger
+    than that runs alone). Waiting requests are admitted in arrival order;
+    when the queued pixels would exceed max_queued_pixels the request is
+    rejected at once. The drain rate (pixels per second) is estimated from
+    completed requests and used to suggest a Retry-After.
+    """
+
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, max_inflight_pixels=ADMISSION_MAX_INFLIGHT_PIXELS,
+                 max_queued_pixels=ADMISSION_MAX_QUEUED_PIXELS, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_inflight_pixels = max_inflight_pixels
+        self.max_queued_pixels = max_queued_pixels
+        self.queue_timeout = queue_timeout
+
+        self._condition = threading.Condition()
+        self._waiting = deque()
+        self.running = 0
+        self.inflight_pixels = 0
+        self.queued_pixels = 0
+
+        # Smoothed pixels per second of one request; drain_rate scales it by the concurrency
+        self._pixels_per_second = None
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def enabled(self):
+        return self.max_concurrent > 0 or self.max_inflight_pixels > 0
+
+    @contextmanager
+    def admit(self, cost):
+        """Wait for a slot for a request of cost pixels; yields the seconds spent queued"""
+        waited = self.acquire(cost)
+        start = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            self.release(cost, time.perf_counter() - start)
+
+    def acquire(self, cost):
+        """Block until the request may run and return the wait in seconds; raises AdmissionRejected"""
+        if not self.enabled:
+            return 0.0
+        start = time.perf_counter()
+        ticket = object()
+        with self._condition:
+            if not self._waiting and self._fits(cost):
+                self._start(cost)
+                return 0.0
+            if self.max_queued_pixels and self.queued_pixels + cost > self.max_queued_pixels and self._waiting:
+                self.rejected += 1
+                raise AdmissionRejected('Server busy: admission queue is full', self._retry_after(cost))
+
+            self._waiting.append(ticket)
+            self.queued_pixels += cost
+            try:
+                deadline = start + self.queue_timeout if self.queue_timeout else None
+                while self._waiting[0] is not ticket or not self._fits(cost):
+                    remaining = None if deadline is None else deadline - time.perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        self.timed_out += 1
+                        raise AdmissionRejected('Server busy: timed out waiting in the admission queue',
+                                                self._retry_after(cost))
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self.queued_pixels -= cost
+                # The next waiter may fit now that this one is gone
+                self._condition.notify_all()
+            self._start(cost)
+        return time.perf_counter() - start
+
+    def release(self, cost, service_seconds):
+        """Give back a slot taken by acquire after service_seconds of processing"""
+        if not self.enabled:
+            return
+        with self._condition:
+            self.running -= 1
+            self.inflight_pixels -= cost
+            if service_seconds > 0:
+                rate = cost / service_seconds
+                if self._pixels_per_second is None:
+                    self._pixels_per_second = rate
+                else:
+                    self._pixels_per_second += DRAIN_RATE_SMOOTHING * (rate - self._pixels_per_second)
+            self._condition.notify_all()
+
+    def drain_rate(self):
+        """Estimated pixels per second the server works through, or None before any request finished"""
+        if self._pixels_per_second is None:
+            return None
+        return self._pixels_per_second * max(1, self.max_concurrent)
+
+    def stats(self):
+        with self._condition:
+            rate = self.drain_rate()
+            return {
+                'running': self.running,
+                'queued': len(self._waiting),
+                'inflight_pixels': self.inflight_pixels,
+                'queued_pixels': self.queued_pixels,
+                'max_concurrent': self.max_concurrent,
+                'max_inflight_pixels': self.max_inflight_pixels,
+                'max_queued_pixels': self.max_queued_pixels,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'drain_pixels_per_second': round(rate) if rate else None,
+            }
+
+    def _fits(self, cost):
+        """Whether a request of cost pixels may start now (condition must be held)"""
+        if self.max_concurrent and self.running >= self.max_concurrent:
+            return False
+        if self.max_inflight_pixels and self.running and self.inflight_pixels + cost > self.max_inflight_pixels:
+            return False
+        return True
+
+    def _start(self, cost):
+        self.running += 1
+        self.inflight_pixels += cost
+        self.admitted += 1
+
+    def _retry_after(self, cost):
+        """Seconds until the work ahead of a new request should have drained (condition must be held)"""
+        rate = self.drain_rate()
+        if not rate:
+            return ADMISSION_DEFAULT_RETRY_AFTER
+        return max(1, math.ceil((self.inflight_pixels + self.queued_pixels + cost) / rate))
@@ -0,0 +1,224 @@
+import os
+import io
+import queue
+import logging
+import zipfile
+import threading
+
+from PIL import Image, ImageOps, ImageSequence
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# Frames whose mean absolute difference from the last keyframe (0-1, on a
+# small grayscale thumbnail) is below this reuse its mask (0 = never)
+MASK_REUSE_THRESHOLD = float(os.environ.get('MASK_REUSE_THRESHOLD', 0.02))
+
+# Consecutive frames that may reuse one keyframe's mask before segmenting again
+MASK_REUSE_MAX_FRAMES = int(os.environ.get('MASK_REUSE_MAX_FRAMES', 10))
+
+# Upper bound on frames per request
+MAX_ANIMATION_FRAMES = int(os.environ.get('MAX_ANIMATION_FRAMES', 300))
+
+# Display time of frames that do not carry one (ZIP and MJPEG inputs)
+DEFAULT_FRAME_DURATION_MS = int(os.environ.get('DEFAULT_FRAME_DURATION_MS', 100))
+
+# Frames buffered between pipeline stages
+ANIMATION_PIPELINE_DEPTH = int(os.environ.get('ANIMATION_PIPELINE_DEPTH', 4))
+
+SIGNATURE_EDGE = 64
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp')
+
+_JPEG_BOUNDARY = b'\xff\xd9\xff\xd8'
+
+
+def animation_kind(data):
+    """'zip', 'mjpeg' or 'animated' for multi-frame inputs, None for a still image"""
+    if data[:4] == b'PK\x03\x04':
+        return 'zip'
+    if data[:2] == b'\xff\xd8':
+        # Back-to-back JPEGs; an EXIF thumbnail never ends right before another SOI
+        return 'mjpeg' if _JPEG_BOUNDARY in data else None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return 'animated' if getattr(image, 'n_frames', 1) > 1 else None
+    except Exception:
+        return None
+
+
+def input_pixel_count(data, kind=None):
+    """Pixels across all frames of an upload (capped at MAX_ANIMATION_FRAMES), from headers only"""
+    kind = kind or animation_kind(data)
+    if kind == 'zip':
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = _zip_frame_names(archive)
+            if not names:
+                return 0
+            with Image.open(archive.open(names[0])) as first:
+                return first.width * first.height * min(len(names), MAX_ANIMATION_FRAMES)
+    with Image.open(io.BytesIO(data)) as image:
+        frames = data.count(_JPEG_BOUNDARY) + 1 if kind == 'mjpeg' else getattr(image, 'n_frames', 1)
+        return image.width * image.height * min(frames, MAX_ANIMATION_FRAMES)
+
+
+def read_frames(data, kind=None):
+    """
+    Yield (RGB frame, duration in ms) for a multi-frame input
+
+    Animated GIF/WebP/PNG frames are composed onto the full canvas by Pillow;
+    ZIP members are read in name order; MJPEG is split at frame boundaries.
+    Yields at most MAX_ANIMATION_FRAMES frames.
+    """
+    kind = kind or animation_kind(data)
+    if kind == 'zip':
+        frames = _zip_frames(data)
+    elif kind == 'mjpeg':
+        frames = _mjpeg_frames(data)
+    else:
+        frames = _animated_frames(data)
+
+    for count, (frame, duration) in enumerate(frames):
+        if count >= MAX_ANIMATION_FRAMES:
+            logger.warning(f"Animation truncated to MAX_ANIMATION_FRAMES={MAX_ANIMATION_FRAMES} frames")
+            return
+        yield frame, duration
+
+
+def loop_count(data, kind=None):
+    """Loop count stored in an animated image (0 = forever)"""
+    if (kind or animation_kind(data)) != 'animated':
+        return 0
+    with Image.open(io.BytesIO(data)) as image:
+        return image.info.get('loop', 0)
+
+
+def _animated_frames(data):
+    with Image.open(io.BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            yield frame.convert('RGB'), frame.info.get('duration') or DEFAULT_FRAME_DURATION_MS
+
+
+def _zip_frames(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = _zip_frame_names(archive)
+        size = None
+        for name in names:
+            with Image.open(io.BytesIO(archive.read(name))) as image:
+                frame = ImageOps.exif_transpose(image).convert('RGB')
+            # Output frames must share one canvas size
+            size = size or frame.size
+            if frame.size != size:
+                frame = frame.resize(size, Image.Resampling.LANCZOS)
+            yield frame, DEFAULT_FRAME_DURATION_MS
+
+
+def _zip_frame_names(archive):
+    return sorted(name for name in archive.namelist()
+                  if name.lower().endswith(FRAME_EXTENSIONS) and not name.startswith('__MACOSX/'))
+
+
+def _mjpeg_frames(data):
+    start = 0
+    while start < len(data):
+        end = data.find(_JPEG_BOUNDARY, start)
+        end = len(data) if end < 0 else end + 2
+        with Image.open(io.BytesIO(data[start:end])) as image:
+            yield image.convert('RGB'), DEFAULT_FRAME_DURATION_MS
+        start = end
+
+
+def frame_signature(frame):
+    """Small grayscale thumbnail used to measure how much a frame changed"""
+    thumbnail = frame.convert('L').resize((SIGNATURE_EDGE, SIGNATURE_EDGE), Image.Resampling.BILINEAR)
+    if NUMPY_AVAILABLE:
+        return np.asarray(thumbnail, dtype=np.float32) / 255
+    return thumbnail
+
+
+def frame_difference(signature, other):
+    """Mean absolute difference of two signatures, from 0 (same) to 1"""
+    if NUMPY_AVAILABLE:
+        return float(np.abs(signature - other).mean())
+    differences = [abs(a - b) for a, b in zip(signature.tobytes(), other.tobytes())]
+    return sum(differences) / (255 * len(differences))
+
+
+class _Failure:
+    """Carries an exception from a pipeline thread to the consumer"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+def pipeline(source, stages, depth=ANIMATION_PIPELINE_DEPTH):
+    """
+    Run an iterable and a chain of per-item functions in overlapping threads
+
+    The source is iterated in one thread and each stage runs in its own,
+    connected by queues holding at most depth items, so decoding, segmentation
+    and compositing of different frames overlap. Yields the last stage's
+    outputs in order; an exception in any thread is re-raised here.
+    """
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q, item):
+        # Give up when the consumer has gone away instead of blocking forever
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], _DONE)
+        except Exception as e:
+            put(queues[0], _Failure(e))
+
+    def work(stage, inbox, outbox):
+        while not stop.is_set():
+            try:
+                item = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE or isinstance(item, _Failure):
+                put(outbox, item)
+                return
+            try:
+                result = stage(item)
+            except Exception as e:
+                put(outbox, _Failure(e))
+                return
+            if not put(outbox, result):
+                return
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads.extend(threading.Thread(target=work, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                   for i, stage in enumerate(stages))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
@@ -1,31 +1,67 @@
 import os
+import io
 import logging
 import re
 import sys
-from flask import Flask, request, jsonify, send_file
+import json
+import time
+import zipfile
+from contextlib import contextmanager
+from flask import Flask, request, jsonify, send_file, g, Response
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
-import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
 import uuid
 
 # Configure logging first
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Import with compatibility handling
+# Import with compatibility handling; its optional libraries load on first use
+_import_start = time.perf_counter()
 try:
-    from minimal_rembg_processor import MinimalBackgroundRemover
+    from minimal_rembg_processor import (MinimalBackgroundRemover, SUPPORTED_MODELS, DEFAULT_MODEL, ImageTooLargeError,
+                                         ENGINE_NAMES, resolve_engine_name)
     BACKGROUND_PROCESSOR_AVAILABLE = True
-    logger.info("Background processor imported successfully")
+    logger.info(f"Background processor imported successfully in {(time.perf_counter() - _import_start) * 1000:.0f}ms")
 except ImportError as e:
     logger.warning(f"Background processor import failed: {e}")
     BACKGROUND_PROCESSOR_AVAILABLE = False
     MinimalBackgroundRemover = None
+    SUPPORTED_MODELS = ()
+    DEFAULT_MODEL = None
+    ImageTooLargeError = ValueError
+    ENGINE_NAMES = ()
+    resolve_engine_name = lambda engine: None
 except Exception as e:
     logger.error(f"Unexpected error importing background processor: {e}")
     BACKGROUND_PROCESSOR_AVAILABLE = False
     MinimalBackgroundRemover = None
+    SUPPORTED_MODELS = ()
+    DEFAULT_MODEL = None
+    ImageTooLargeError = ValueError
+    ENGINE_NAMES = ()
+    resolve_engine_name = lambda engine: None
+
+from job_queue import JobManager, QueueFullError
+from background_library import BackgroundLibrary, LibraryFullError
+from image_encoding import (available_formats, negotiate_format, normalize_format, format_mimetype, format_extension,
+                            animation_format)
+from animation import animation_kind
+from admission import AdmissionController, AdmissionRejected, request_cost
+from metrics import MetricsRegistry
+from timing import ProfileSampler, report_timer, log_timings
+from engine_selection import QUALITY_TIERS
+from result_store import ResultStore, RESULT_CACHE_MAX_AGE
+from backends import BACKENDS, WARMUP_BACKENDS
+from engine_registry import EngineUnavailable
+try:
+    from inference_pool import InferencePool, INFERENCE_POOL_SIZE
+except ImportError as e:
+    logger.warning(f"Inference pool unavailable: {e}")
+    InferencePool = None
+    INFERENCE_POOL_SIZE = 0
 
 # Create Flask app
 app = Flask(__name__)
@@ -33,27 +69,69 @@ app.secret_key = os.environ.get("SESSION_SECRET", "default_secret_key_for_dev")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Enable CORS
-CORS(app, origins="*", methods=["GET", "POST", "OPTIONS"])
+CORS(app, origins="*", methods=["GET", "POST", "DELETE", "OPTIONS"])
 
 # Configuration
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
-UPLOAD_FOLDER = tempfile.gettempdir()
+# Multi-frame inputs accepted by /remove-background
+ANIMATION_EXTENSIONS = {'gif', 'zip', 'mjpeg', 'mjpg'}
+# Alpha-only outputs of /remove-background: output mode -> (mimetype, extension)
+MASK_OUTPUTS = {'mask': ('image/png', 'png'), 'rle': ('application/json', 'json')}
+RESULT_MIMETYPES = {'json': 'application/json'}
+MIN_PROXY_EDGE = 64
+MAX_PROXY_EDGE = 8192
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', 20))
+MAX_BATCH_CONTENT_LENGTH = int(os.environ.get('MAX_BATCH_CONTENT_LENGTH', 50 * 1024 * 1024))  # 50MB
+# WSGI environ key where the ASGI server (asgi_app.py) puts the seconds it spent reading the body
+RECEIVE_SECONDS_KEY = 'bgremoval.receive_seconds'
+
+# Warm up rembg sessions at import time so `gunicorn --preload` pays the
+# model load once in the master instead of on the first request
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'true').lower() in ('1', 'true', 'yes')
+PRELOAD_MODELS = [m.strip() for m in os.environ.get('PRELOAD_MODELS', DEFAULT_MODEL or '').split(',') if m.strip()]
 
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Initialize background remover (lazy loading)
+# Initialize background remover and job manager (lazy loading)
 bg_remover = None
+job_manager = None
+
+# Registered backgrounds shared by every request
+background_library = BackgroundLibrary()
+
+# Durable store of encoded results, enabled by RESULT_STORE_DIR
+result_store = ResultStore()
+
+# Limits concurrent processing and queues the rest by pixel cost
+admission = AdmissionController()
+
+# Prometheus metrics for this process
+metrics = MetricsRegistry()
+REQUESTS_TOTAL = metrics.counter(
+    'bgremoval_http_requests_total', 'HTTP requests by endpoint, method and status code',
+    ('endpoint', 'method', 'status'))
+REQUESTS_IN_FLIGHT = metrics.gauge(
+    'bgremoval_http_requests_in_flight', 'HTTP requests currently being handled')
+PROCESSING_SECONDS = metrics.histogram(
+    'bgremoval_processing_duration_seconds',
+    'Latency of image processing requests by background type and engine, excluding admission queue wait',
+    ('endpoint', 'background_type', 'engine'))
+QUEUE_WAIT_SECONDS = metrics.histogram(
+    'bgremoval_queue_wait_seconds', 'Time processing requests waited in the admission queue', ('endpoint',))
+
+# Samples one in every PROFILE_SAMPLE_EVERY processing requests
+profile_sampler = ProfileSampler()
+PROFILED_ENDPOINTS = {'remove_background', 'remove_background_batch'}
 
 # Utility functions
-def validate_image(file):
+def validate_image(file, extensions=ALLOWED_EXTENSIONS):
     """Validate uploaded image file"""
     if not file or file.filename == '':
         return False
     
     filename = file.filename.lower()
-    return any(filename.endswith('.' + ext) for ext in ALLOWED_EXTENSIONS)
+    return any(filename.endswith('.' + ext) for ext in extensions)
 
 def validate_hex_color(hex_color):
     """Validate hex color format"""
@@ -79,6 +157,410 @@ def get_file_extension(filename):
         return ''
     return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
 
+def get_bg_remover():
+    """Return the shared background remover, creating it on first use"""
+    global bg_remover
+    if bg_remover is None:
+        logger.info("Initializing background remover...")
+        pool = InferencePool() if INFERENCE_POOL_SIZE > 0 else None
+        bg_remover = MinimalBackgroundRemover(inference_pool=pool, background_library=background_library)
+        logger.info("Background remover initialized successfully")
+    return bg_remover
+
+def get_job_manager():
+    """Return the shared job manager, starting its worker pool on first use"""
+    global job_manager
+    if job_manager is None:
+        job_manager = JobManager(remover_factory=get_bg_remover)
+    return job_manager
+
+def load_bg_remover():
+    """Return (remover, None), or (None, error_response) if it cannot be created"""
+    if not BACKGROUND_PROCESSOR_AVAILABLE or MinimalBackgroundRemover is None:
+        return None, (jsonify({'error': 'Background processing not available. Please check installation.'}), 500)
+    try:
+        return get_bg_remover(), None
+    except Exception as e:
+        logger.error(f"Failed to initialize background remover: {e}")
+        return None, (jsonify({'error': f'Background processor initialization failed: {str(e)}'}), 500)
+
+def parse_processing_options():
+    """
+    Read and validate the background/model form fields shared by the processing endpoints
+    
+    Returns (options, None) with keyword arguments for the remover, or
+    (None, error_response) if the request is invalid.
+    """
+    background_type = request.form.get('background_type', 'transparent')
+    background_color = request.form.get('background_color', '')
+    background_image = request.files.get('background_image')
+    background_id = request.form.get('background_id') or None
+    model = request.form.get('model') or DEFAULT_MODEL
+    
+    # Validate model
+    if model not in SUPPORTED_MODELS:
+        return None, (jsonify({'error': f"Invalid model. Must be one of: {', '.join(SUPPORTED_MODELS)}"}), 400)
+    
+    # Validate a forced segmentation engine
+    engine = request.form.get('engine') or None
+    if engine is not None and resolve_engine_name(engine) is None:
+        return None, (jsonify({'error': f"Invalid engine. Must be one of: {', '.join(ENGINE_NAMES)}"}), 400)
+    
+    # Validate proxy segmentation size (0 segments at full resolution)
+    proxy_edge = request.form.get('proxy_edge')
+    if proxy_edge not in (None, ''):
+        try:
+            proxy_edge = int(proxy_edge)
+        except ValueError:
+            proxy_edge = -1
+        if proxy_edge != 0 and not MIN_PROXY_EDGE <= proxy_edge <= MAX_PROXY_EDGE:
+            return None, (jsonify({'error': f'Invalid proxy_edge. Use 0 or a value from {MIN_PROXY_EDGE} to {MAX_PROXY_EDGE}'}), 400)
+    else:
+        proxy_edge = None
+    
+    # Validate background type
+    if background_type not in ['transparent', 'solid', 'image', 'blur', 'tint']:
+        return None, (jsonify({'error': 'Invalid background_type. Must be: transparent, solid, image, blur, or tint'}), 400)
+    
+    # Validate solid color background
+    if background_type == 'solid':
+        if not background_color:
+            return None, (jsonify({'error': 'background_color is required for solid background'}), 400)
+        if not validate_hex_color(background_color):
+            return None, (jsonify({'error': 'Invalid hex color format. Use format: #RRGGBB'}), 400)
+    
+    # Validate image background
+    background_image_data = None
+    if background_type == 'image' and background_id:
+        if background_library.get(background_id) is None:
+            return None, (jsonify({'error': f'Unknown background_id: {background_id}'}), 400)
+    elif background_type == 'image':
+        if not background_image or background_image.filename == '':
+            return None, (jsonify({'error': 'background_image or background_id is required for image background'}), 400)
+        if not validate_image(background_image):
+            return None, (jsonify({'error': 'Invalid background image file. Supported formats: PNG, JPG, JPEG, WebP'}), 400)
+        background_image_data = background_image.read()
+        logger.info(f"Received background image: {len(background_image_data)} bytes")
+    
+    # Validate blurred and tinted background settings
+    blur_radius, error = parse_int_field('blur_radius', 1, 100)
+    if error:
+        return None, error
+    tint_color = request.form.get('tint_color') or None
+    if tint_color and not validate_hex_color(tint_color):
+        return None, (jsonify({'error': 'Invalid tint_color format. Use format: #RRGGBB'}), 400)
+    tint_strength, error = parse_int_field('tint_strength', 0, 100)
+    if error:
+        return None, error
+    
+    # Validate output encoding; without an explicit format negotiate from Accept
+    output_format = request.form.get('output_format')
+    if output_format:
+        fmt = normalize_format(output_format)
+        if fmt is None or fmt not in available_formats():
+            return None, (jsonify({'error': f"Invalid output_format. Must be one of: {', '.join(available_formats())}"}), 400)
+        if fmt == 'jpeg' and background_type == 'transparent':
+            return None, (jsonify({'error': 'output_format jpeg cannot carry a transparent background'}), 400)
+        output_format = fmt
+    else:
+        output_format = negotiate_format(request.headers.get('Accept'), has_alpha=background_type == 'transparent')
+    
+    # quality is either an encoder quality or a segmentation quality tier
+    quality_tier = None
+    if (request.form.get('quality') or '').strip().lower() in QUALITY_TIERS:
+        quality_tier, quality = request.form['quality'].strip().lower(), None
+    else:
+        quality, error = parse_int_field('quality', 1, 100)
+        if error:
+            return None, (jsonify({'error': f"Invalid quality. Must be an integer from 1 to 100 or one of: {', '.join(QUALITY_TIERS)}"}), 400)
+    max_latency_ms, error = parse_int_field('max_latency_ms', 1, 600000)
+    if error:
+        return None, error
+    compression, error = parse_int_field('compression', 0, 9)
+    if error:
+        return None, error
+    
+    return {
+        'background_type': background_type,
+        'background_color': background_color,
+        'background_image_data': background_image_data,
+        'background_id': background_id if background_type == 'image' else None,
+        'model': model,
+        'proxy_edge': proxy_edge,
+        'blur_radius': blur_radius if background_type == 'blur' else None,
+        'tint_color': tint_color if background_type == 'tint' else None,
+        'tint_strength': tint_strength if background_type == 'tint' else None,
+        'output_format': output_format,
+        'quality': quality,
+        'compression': compression,
+        'quality_tier': quality_tier,
+        'max_latency_ms': max_latency_ms,
+        'engine': engine
+    }, None
+
+def parse_int_field(name, minimum, maximum):
+    """Read an optional integer form field; returns (value or None, error_response or None)"""
+    value = request.form.get(name)
+    if value in (None, ''):
+        return None, None
+    try:
+        value = int(value)
+    except ValueError:
+        value = None
+    if value is None or not minimum <= value <= maximum:
+        return None, (jsonify({'error': f'Invalid {name}. Must be an integer from {minimum} to {maximum}'}), 400)
+    return value, None
+
+def result_type(output_format):
+    """(mimetype, extension) of a result in an output format or mask output mode"""
+    if output_format in MASK_OUTPUTS:
+        return MASK_OUTPUTS[output_format]
+    return format_mimetype(output_format), format_extension(output_format)
+
+def send_result(result, output_format, download_id):
+    """Send encoded result bytes, or the path of a stored result, as an attachment with the matching mimetype"""
+    mimetype, extension = result_type(output_format)
+    response = send_file(
+        io.BytesIO(result) if isinstance(result, bytes) else result,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f"processed_{download_id}.{extension}"
+    )
+    # The format may have been negotiated from the Accept header
+    response.headers['Vary'] = 'Accept'
+    return response
+
+def add_result_location(response, key, output_format):
+    """Point a processing response at the stable URL of its stored result"""
+    relative_path = ResultStore.relative_path(key, result_type(output_format)[1])
+    response.set_etag(key)
+    response.headers['Content-Location'] = f"/results/{relative_path}"
+    return response
+
+def receive_seconds():
+    """Time spent receiving the upload, as measured by the ASGI server when it read the body first"""
+    received = request.environ.get(RECEIVE_SECONDS_KEY)
+    return (received or 0.0) + time.perf_counter() - g.request_started
+
+@contextmanager
+def admit_request(cost, report):
+    """Hold an admission slot for a request of cost pixels, recording the wait; raises AdmissionRejected"""
+    with admission.admit(cost) as waited:
+        g.queue_wait = waited
+        report_timer(report).add('queue', waited)
+        yield
+
+def busy_response(error):
+    """429 telling the client when the admission queue should have drained"""
+    logger.warning(f"Rejected request: {error} (retry after {error.retry_after}s)")
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def warm_up_models():
+    """Create and warm the rembg sessions listed in PRELOAD_MODELS"""
+    if not BACKGROUND_PROCESSOR_AVAILABLE:
+        return
+    if INFERENCE_POOL_SIZE > 0:
+        # Pool processes warm their own sessions when they start; starting
+        # them here would tie them to the gunicorn master
+        logger.info("Inference pool enabled, skipping warm-up in the app process")
+        return
+    try:
+        remover = get_bg_remover()
+    except Exception as e:
+        logger.error(f"Failed to initialize background remover for warm-up: {e}")
+        return
+    for model in PRELOAD_MODELS:
+        if model not in SUPPORTED_MODELS:
+            logger.warning(f"Skipping warm-up of unsupported model: {model}")
+            continue
+        remover.warm_up(model)
+
+def processor_status():
+    """Describe the shared remover without creating it"""
+    if not BACKGROUND_PROCESSOR_AVAILABLE:
+        return 'unavailable'
+    if bg_remover is None:
+        return 'not_initialized'
+    if bg_remover.fallback_mode or (bg_remover.inference_pool is not None and bg_remover.inference_pool.fallback_mode):
+        return 'fallback_mode'
+    return 'full_functionality'
+
+def open_engines(remover):
+    """Names of engines whose circuit breaker is not closed"""
+    if remover is None:
+        return []
+    return sorted(name for name, breaker in remover.engines.breakers.items() if breaker.state != 'closed')
+
+def readiness_state():
+    """Return (ready, state) from the shared remover and job queue"""
+    remover = bg_remover
+    queue = job_manager.stats() if job_manager is not None else None
+    state = {
+        'processor_status': processor_status(),
+        'models_loaded': sorted(remover.sessions) if remover is not None else [],
+        'models_warmed': sorted(remover.warmed_models) if remover is not None else [],
+        'models_warmup_failed': dict(remover.warmup_failures) if remover is not None else {},
+        'model_variants': dict(remover.session_variants) if remover is not None else {},
+        'inference_pool': remover.inference_pool.stats() if remover is not None and remover.inference_pool else None,
+        'queue_depth': queue['queued'] + queue['running'] if queue else 0,
+        'queue_capacity': queue['max_pending'] if queue else None,
+        'admission': admission.stats() if admission.enabled else None,
+        'open_engines': open_engines(remover),
+    }
+    
+    reasons = []
+    if not BACKGROUND_PROCESSOR_AVAILABLE:
+        reasons.append('background processor unavailable')
+    elif WARMUP_ON_START and INFERENCE_POOL_SIZE == 0:
+        # Warm-up was requested, so wait for it unless rembg is out of the picture. A
+        # model whose warm-up failed is not waited for: requests fall back (degraded)
+        expected = [m for m in PRELOAD_MODELS if m in SUPPORTED_MODELS]
+        if remover is None:
+            reasons.append('background remover not initialized')
+        else:
+            pending = set(expected) - remover.warmed_models - set(remover.warmup_failures)
+            if not remover.fallback_mode and pending:
+                reasons.append('models not warmed: ' + ', '.join(sorted(pending)))
+    state['degraded'] = bool(remover is not None and (remover.warmup_failures or remover.fallback_mode))
+    if queue and state['queue_depth'] >= queue['max_pending']:
+        reasons.append('job queue full')
+    if admission.max_queued_pixels and admission.queued_pixels >= admission.max_queued_pixels:
+        reasons.append('admission queue full')
+    
+    state['reasons'] = reasons
+    return not reasons, state
+
+def collect_service_metrics():
+    """Scrape-time samples read from the remover, caches, job queue and pool"""
+    remover = bg_remover
+    pool = remover.inference_pool if remover is not None else None
+    yield ('bgremoval_ready', 'gauge', 'Whether /readyz currently reports ready', int(readiness_state()[0]))
+    if remover is not None:
+        fallback = remover.fallback_mode or bool(pool and pool.fallback_mode)
+        activations = remover.fallback_activations + (pool.fallback_activations if pool else 0)
+        yield ('bgremoval_fallback_mode', 'gauge', 'Whether segmentation is using the non-AI fallback', int(fallback))
+        yield ('bgremoval_fallback_activations_total', 'counter', 'Times rembg was abandoned for the fallback', activations)
+        yield ('bgremoval_models_loaded', 'gauge', 'rembg sessions created in this process', len(remover.sessions))
+        yield ('bgremoval_models_warmed', 'gauge', 'rembg sessions warmed in this process', len(remover.warmed_models))
+        yield ('bgremoval_engine_breakers_open', 'gauge', 'Engines whose circuit breaker is open or half-open', len(open_engines(remover)))
+        
+        cache = remover.mask_cache.stats()
+        yield ('bgremoval_mask_cache_hits_total', 'counter', 'Mask cache hits in memory', cache['hits'])
+        yield ('bgremoval_mask_cache_disk_hits_total', 'counter', 'Mask cache hits on disk', cache['disk_hits'])
+        yield ('bgremoval_mask_cache_misses_total', 'counter', 'Mask cache misses', cache['misses'])
+        yield ('bgremoval_mask_cache_evictions_total', 'counter', 'Mask cache evictions from memory', cache['evictions'])
+        yield ('bgremoval_mask_cache_entries', 'gauge', 'Masks held in memory', cache['entries'])
+        yield ('bgremoval_mask_cache_bytes', 'gauge', 'Bytes of masks held in memory', cache['bytes'])
+        yield ('bgremoval_mask_cache_disk_bytes', 'gauge', 'Bytes of masks held on disk', cache['disk_bytes'])
+        
+        flights = remover.single_flight.stats()
+        yield ('bgremoval_single_flight_executed_total', 'counter', 'Mask computations started for uncached requests', flights['executed'])
+        yield ('bgremoval_single_flight_coalesced_total', 'counter', 'Requests that waited for an identical in-flight mask', flights['coalesced'])
+        yield ('bgremoval_single_flight_shared_errors_total', 'counter', 'Coalesced requests that got the first request\'s error', flights['shared_errors'])
+        yield ('bgremoval_single_flight_in_flight', 'gauge', 'Mask computations other requests can join', flights['in_flight'])
+    
+    if admission.enabled:
+        admitted = admission.stats()
+        yield ('bgremoval_admission_running', 'gauge', 'Requests holding an admission slot', admitted['running'])
+        yield ('bgremoval_admission_queued', 'gauge', 'Requests waiting in the admission queue', admitted['queued'])
+        yield ('bgremoval_admission_inflight_pixels', 'gauge', 'Decoded pixels of admitted requests', admitted['inflight_pixels'])
+        yield ('bgremoval_admission_queued_pixels', 'gauge', 'Decoded pixels of queued requests', admitted['queued_pixels'])
+        yield ('bgremoval_admission_rejected_total', 'counter', 'Requests turned away because the queue was full', admitted['rejected'])
+        yield ('bgremoval_admission_timeouts_total', 'counter', 'Requests that gave up waiting in the queue', admitted['timed_out'])
+        yield ('bgremoval_admission_drain_pixels_per_second', 'gauge', 'Estimated pixels processed per second', admitted['drain_pixels_per_second'])
+    
+    if result_store.enabled:
+        store = result_store.stats()
+        yield ('bgremoval_result_store_hits_total', 'counter', 'Requests answered from the result store', store['hits'])
+        yield ('bgremoval_result_store_misses_total', 'counter', 'Result store lookups that found nothing', store['misses'])
+        yield ('bgremoval_result_store_evictions_total', 'counter', 'Results removed to stay under budget', store['evictions'])
+        yield ('bgremoval_result_store_bytes', 'gauge', 'Bytes of results held in the store', store['bytes'])
+    
+    library = background_library.stats()
+    yield ('bgremoval_backgrounds', 'gauge', 'Registered backgrounds', library['backgrounds'])
+    yield ('bgremoval_background_variant_hits_total', 'counter', 'Resized background cache hits', library['variant_hits'])
+    yield ('bgremoval_background_variant_misses_total', 'counter', 'Resized background cache misses', library['variant_misses'])
+    yield ('bgremoval_background_variant_bytes', 'gauge', 'Bytes of resized backgrounds held', library['variant_bytes'])
+    
+    if job_manager is not None:
+        jobs = job_manager.stats()
+        yield ('bgremoval_jobs_queued', 'gauge', 'Jobs waiting for a worker', jobs['queued'])
+        yield ('bgremoval_jobs_running', 'gauge', 'Jobs being processed', jobs['running'])
+        yield ('bgremoval_jobs_completed_total', 'counter', 'Jobs finished successfully', jobs['completed'])
+        yield ('bgremoval_jobs_failed_total', 'counter', 'Jobs that failed', jobs['failed'])
+    
+    if pool is not None:
+        pool_stats = pool.stats()
+        yield ('bgremoval_inference_pool_completed_total', 'counter', 'Segmentations run in the pool', pool_stats['completed'])
+        yield ('bgremoval_inference_pool_failed_total', 'counter', 'Pool segmentations that raised', pool_stats['failed'])
+
+metrics.register_collector(collect_service_metrics)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    if request.endpoint in PROFILED_ENDPOINTS:
+        g.profiler = profile_sampler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS_TOTAL.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    labels = g.pop('processing_labels', None)
+    if labels is not None and 'request_started' in g:
+        elapsed = time.perf_counter() - g.request_started
+        queue_wait = g.pop('queue_wait', 0.0)
+        QUEUE_WAIT_SECONDS.observe(queue_wait, endpoint=endpoint)
+        PROCESSING_SECONDS.observe(elapsed - queue_wait, endpoint=endpoint, **labels)
+        
+        # Per-stage breakdown for the client and the logs
+        report = g.pop('processing_report', None)
+        if report is not None and report.get('engine'):
+            response.headers['X-Segmentation-Engine'] = report['engine']
+            if report.get('coalesced'):
+                response.headers['X-Mask-Coalesced'] = 'true'
+            if 'plan' in report:
+                response.headers['X-Quality-Tier'] = report['plan']['tier']
+            if 'frames' in report:
+                response.headers['X-Animation-Frames'] = str(report['frames'])
+                response.headers['X-Animation-Keyframes'] = str(report['keyframes'])
+        if report is not None and 'timings' in report:
+            timer = report['timings']
+            response.headers['Server-Timing'] = timer.server_timing(total=elapsed)
+            log_timings('request_timing', timer, elapsed, endpoint=endpoint, status=response.status_code,
+                        image_size=report.get('image_size'), input_bytes=request.content_length,
+                        output_bytes=response.content_length, **labels)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    if g.pop('request_started', None) is not None:
+        REQUESTS_IN_FLIGHT.dec()
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profile_sampler.stop(profiler, request.endpoint)
+
+@app.route('/livez', methods=['GET'])
+def livez():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'alive'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness probe from the shared remover's real state; 503 until it can take traffic"""
+    ready, state = readiness_state()
+    state['status'] = 'ready' if ready else 'not_ready'
+    return jsonify(state), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint for monitoring with compatibility info"""
@@ -90,30 +572,17 @@ def health_check():
             'flask_available': True,
             'pil_available': True,  # We know PIL is available if we got this far
             'numpy_available': 'numpy' in sys.modules,
-            'scipy_available': 'scipy' in sys.modules,
-            'opencv_available': 'cv2' in sys.modules,
-            'skimage_available': 'skimage' in sys.modules
+            'scipy_available': BACKENDS.available('scipy'),
+            'opencv_available': BACKENDS.available('cv2'),
+            'skimage_available': BACKENDS.available('skimage'),
+            'backends': BACKENDS.report(),
         }
         
-        # Try to check if background remover can initialize
-        processor_status = 'available'
-        try:
-            if BACKGROUND_PROCESSOR_AVAILABLE:
-                test_processor = MinimalBackgroundRemover()
-                if test_processor.fallback_mode:
-                    processor_status = 'fallback_mode'
-                else:
-                    processor_status = 'full_functionality'
-            else:
-                processor_status = 'unavailable'
-        except Exception as e:
-            processor_status = f'error: {str(e)}'
-        
         return jsonify({
             'status': 'healthy',
             'service': 'background-removal-api',
             'version': '1.0.1',
-            'processor_status': processor_status,
+            'processor_status': processor_status(),
             'compatibility': compatibility_status,
             'deployment_ready': True,
             'port': os.environ.get('PORT', '5000'),
@@ -133,9 +602,25 @@ def remove_background():
     
     Form data:
     - image: Image file (required)
-    - background_type: 'transparent', 'solid', or 'image' (default: 'transparent')
+    - background_type: 'transparent', 'solid', 'image', 'blur' or 'tint' (default: 'transparent')
     - background_color: Hex color for solid background (required if background_type='solid')
-    - background_image: Background image file (required if background_type='image')
+    - background_image: Background image file (required if background_type='image' without background_id)
+    - background_id: id of a background registered through POST /backgrounds
+    - blur_radius: 1-100, blur applied to the original background for 'blur' (default: 20)
+    - tint_color, tint_strength: hex color and 0-100 percent washed over the original background for 'tint'
+    - model: rembg model to use (default: REMBG_MODEL, see SUPPORTED_MODELS)
+    - proxy_edge: segment on a copy with this long edge and refine the mask at full size (0 = off)
+    - output_format: 'png', 'webp', 'jpeg' or 'avif' (default: negotiated from the Accept header)
+    - quality: 1-100 for lossy formats, or 'fast', 'balanced' or 'best' to pick the segmentation engine and resolution
+    - max_latency_ms: segmentation budget; picks the best engine and resolution predicted to fit
+    - compression: encoder effort from 0 (fastest) to 9 (smallest)
+    
+    - output: 'image' (default), 'mask' for the alpha alone as a PNG, or 'rle' for
+      the run-length-encoded alpha and its bounding box as JSON
+    - mask_depth: 8 (grayscale, default) or 1 (bilevel) for output=mask
+    
+    Animated GIF/WebP/PNG, MJPEG and ZIPs of frames are processed frame by
+    frame and returned as animated WebP, or APNG with output_format=png.
     """
     try:
         # Check if image file is present
@@ -147,112 +632,363 @@ def remove_background():
             return jsonify({'error': 'No image file selected'}), 400
         
         # Validate image file
-        if not validate_image(image_file):
-            return jsonify({'error': 'Invalid image file. Supported formats: PNG, JPG, JPEG, WebP'}), 400
+        if not validate_image(image_file, ALLOWED_EXTENSIONS | ANIMATION_EXTENSIONS):
+            return jsonify({'error': 'Invalid image file. Supported formats: PNG, JPG, JPEG, WebP, GIF, MJPEG, ZIP of frames'}), 400
         
-        # Get background options
-        background_type = request.form.get('background_type', 'transparent')
-        background_color = request.form.get('background_color', '')
-        background_image = request.files.get('background_image')
+        # Get and validate background options
+        options, error = parse_processing_options()
+        if error:
+            return error
         
-        # Validate background type
-        if background_type not in ['transparent', 'solid', 'image']:
-            return jsonify({'error': 'Invalid background_type. Must be: transparent, solid, or image'}), 400
-        
-        # Validate solid color background
-        if background_type == 'solid':
-            if not background_color:
-                return jsonify({'error': 'background_color is required for solid background'}), 400
-            if not validate_hex_color(background_color):
-                return jsonify({'error': 'Invalid hex color format. Use format: #RRGGBB'}), 400
-        
-        # Validate image background
-        if background_type == 'image':
-            if not background_image or background_image.filename == '':
-                return jsonify({'error': 'background_image is required for image background'}), 400
-            if not validate_image(background_image):
-                return jsonify({'error': 'Invalid background image file. Supported formats: PNG, JPG, JPEG, WebP'}), 400
-        
-        # Generate unique filename
+        # Alpha-only output skips compositing and image encoding
+        output = request.form.get('output') or 'image'
+        if output not in ('image',) + tuple(MASK_OUTPUTS):
+            return jsonify({'error': f"Invalid output. Must be one of: image, {', '.join(MASK_OUTPUTS)}"}), 400
+        mask_depth = request.form.get('mask_depth') or '8'
+        if mask_depth not in ('1', '8'):
+            return jsonify({'error': 'Invalid mask_depth. Must be 1 or 8'}), 400
+        mask_depth = int(mask_depth)
+        
+        # Read uploads straight from the request stream; nothing touches disk
         unique_id = str(uuid.uuid4())
-        original_ext = get_file_extension(image_file.filename)
-        temp_input_path = os.path.join(UPLOAD_FOLDER, f"{unique_id}_input.{original_ext}")
-        temp_output_path = os.path.join(UPLOAD_FOLDER, f"{unique_id}_output.png")
-        
-        # Save uploaded image
-        image_file.save(temp_input_path)
-        logger.info(f"Saved input image: {temp_input_path}")
-        
-        # Save background image if provided
-        bg_image_path = None
-        if background_type == 'image' and background_image:
-            bg_ext = get_file_extension(background_image.filename)
-            bg_image_path = os.path.join(UPLOAD_FOLDER, f"{unique_id}_bg.{bg_ext}")
-            background_image.save(bg_image_path)
-            logger.info(f"Saved background image: {bg_image_path}")
+        input_data = image_file.read()
+        logger.info(f"Received input image: {len(input_data)} bytes")
+        report = g.processing_report = {}
+        report_timer(report).add('receive', receive_seconds())
         
         # Initialize background remover if not already done
-        global bg_remover
-        if bg_remover is None:
-            if not BACKGROUND_PROCESSOR_AVAILABLE or MinimalBackgroundRemover is None:
-                return jsonify({'error': 'Background processing not available. Please check installation.'}), 500
-            
-            logger.info("Initializing background remover...")
-            try:
-                bg_remover = MinimalBackgroundRemover()
-                logger.info("Background remover initialized successfully")
-            except Exception as e:
-                logger.error(f"Failed to initialize background remover: {e}")
-                return jsonify({'error': f'Background processor initialization failed: {str(e)}'}), 500
-        
-        # Process image with background remover
-        logger.info(f"Processing image with background_type: {background_type}")
-        success = bg_remover.remove_background(
-            input_path=temp_input_path,
-            output_path=temp_output_path,
-            background_type=background_type,
-            background_color=background_color,
-            background_image_path=bg_image_path
-        )
+        remover, error = load_bg_remover()
+        if error:
+            return error
+        
+        # Multi-frame inputs come back as an animation in a format that can carry one
+        animation = animation_kind(input_data)
+        if animation and output != 'image':
+            return jsonify({'error': f'output={output} is not supported for animations'}), 400
+        if animation:
+            options['output_format'] = animation_format(options['output_format'])
+        result_format = output if output != 'image' else options['output_format']
+        background_label = 'none' if output != 'image' else options['background_type']
+        
+        # Serve a stored result for the same input, options and engine without reprocessing
+        store_key = engine_version = None
+        if result_store.enabled:
+            engine_version = remover.engine_version()
+            key_options = options if output == 'image' else dict(options, output=output, mask_depth=mask_depth)
+            store_key = result_store.make_key(input_data, key_options, engine_version)
+            stored_path = result_store.get(store_key, result_type(result_format)[1])
+            if stored_path is not None:
+                logger.info(f"Serving stored result {store_key}")
+                report['engine'] = 'store'
+                g.processing_labels = {'background_type': background_label, 'engine': 'store'}
+                response = send_result(stored_path, result_format, unique_id)
+                return add_result_location(response, store_key, result_format)
+        
+        # Wait for a processing slot, or turn the request away while the queue is full
+        cost = request_cost(input_data)
+        with admit_request(cost, report):
+            logger.info(f"Processing image with background_type: {options['background_type']}, model: {options['model']}, output: {output}")
+            if output != 'image':
+                result_data = remover.remove_background_mask(
+                    input_data, output, mask_depth, options['compression'], model=options['model'],
+                    proxy_edge=options['proxy_edge'], quality_tier=options['quality_tier'],
+                    max_latency_ms=options['max_latency_ms'], engine=options['engine'], report=report
+                )
+            elif animation:
+                result_data = remover.remove_background_animation(input_data, report=report, **options)
+            else:
+                result_data = remover.remove_background_bytes(input_data, report=report, **options)
+        g.processing_labels = {'background_type': background_label, 'engine': report.get('engine', 'none')}
         
-        if not success:
+        if result_data is None:
             return jsonify({'error': 'Failed to process image'}), 500
         
-        # Return processed image
-        logger.info(f"Successfully processed image: {temp_output_path}")
-        
-        def cleanup_files():
-            """Clean up temporary files after sending response"""
-            try:
-                if os.path.exists(temp_input_path):
-                    os.remove(temp_input_path)
-                if os.path.exists(temp_output_path):
-                    os.remove(temp_output_path)
-                if bg_image_path and os.path.exists(bg_image_path):
-                    os.remove(bg_image_path)
-                logger.info("Temporary files cleaned up")
-            except Exception as e:
-                logger.error(f"Error cleaning up files: {str(e)}")
-        
-        # Return processed image and schedule cleanup
-        try:
-            return send_file(
-                temp_output_path,
-                mimetype='image/png',
-                as_attachment=True,
-                download_name=f"processed_{unique_id}.png"
-            )
-        finally:
-            # Schedule cleanup after sending file
-            import threading
-            cleanup_thread = threading.Thread(target=cleanup_files)
-            cleanup_thread.daemon = True
-            cleanup_thread.start()
+        # Return processed image from memory
+        logger.info(f"Successfully processed image: {len(result_data)} bytes as {result_format}")
+        response = send_result(result_data, result_format, unique_id)
+        # A result made after rembg fell back does not belong under the rembg key
+        if store_key is not None and remover.made_by_version(report.get('engine'), engine_version) \
+                and result_store.put(store_key, result_type(result_format)[1], result_data):
+            add_result_location(response, store_key, result_format)
+        return response
         
+    except AdmissionRejected as e:
+        return busy_response(e)
+    except ImageTooLargeError as e:
+        logger.warning(f"Rejected oversized image: {e}")
+        return jsonify({'error': str(e)}), 413
+    except EngineUnavailable as e:
+        logger.warning(f"Requested engine unavailable: {e}")
+        return jsonify({'error': str(e), 'engine': e.engine, 'breaker_state': e.state}), 503
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler with this route's limit
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
+@app.route('/remove-background/batch', methods=['POST'])
+def remove_background_batch():
+    """
+    Remove backgrounds from several images sharing one background spec
+    
+    Form data:
+    - images: Image files (required, repeat the field for each image)
+    - background_type, background_color, background_image, model: as for /remove-background
+    
+    Returns a ZIP with one result per input and a manifest.json describing each entry.
+    """
+    try:
+        # Batches legitimately carry more data than a single upload
+        request.max_content_length = MAX_BATCH_CONTENT_LENGTH
+        
+        image_files = [f for f in request.files.getlist('images') if f.filename != '']
+        if not image_files:
+            return jsonify({'error': 'No image files provided'}), 400
+        if len(image_files) > MAX_BATCH_IMAGES:
+            return jsonify({'error': f'Too many images. Maximum batch size is {MAX_BATCH_IMAGES}'}), 400
+        
+        invalid = [f.filename for f in image_files if not validate_image(f)]
+        if invalid:
+            return jsonify({
+                'error': 'Invalid image file. Supported formats: PNG, JPG, JPEG, WebP',
+                'files': invalid
+            }), 400
+        
+        options, error = parse_processing_options()
+        if error:
+            return error
+        
+        inputs = [f.read() for f in image_files]
+        logger.info(f"Received batch of {len(inputs)} images: {sum(len(d) for d in inputs)} bytes")
+        report = g.processing_report = {}
+        report_timer(report).add('receive', receive_seconds())
+        
+        remover, error = load_bg_remover()
+        if error:
+            return error
+        
+        cost = sum(request_cost(input_data) for input_data in inputs)
+        with admit_request(cost, report):
+            results = remover.remove_background_batch(inputs, report=report, **options)
+        g.processing_labels = {'background_type': options['background_type'], 'engine': report.get('engine', 'none')}
+        
+        # Encoded images are already compressed, so store them without deflating again
+        unique_id = str(uuid.uuid4())
+        manifest = []
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zf:
+            for index, (image_file, result_data) in enumerate(zip(image_files, results)):
+                base_name = secure_filename(image_file.filename).rsplit('.', 1)[0] or 'image'
+                entry = {'index': index, 'source': image_file.filename}
+                if result_data is None:
+                    entry['error'] = 'Failed to process image'
+                else:
+                    entry['file'] = f"{index:03d}_{base_name}.{format_extension(options['output_format'])}"
+                    zf.writestr(entry['file'], result_data)
+                manifest.append(entry)
+            zf.writestr('manifest.json', json.dumps(manifest, indent=2))
+        
+        failed = sum(1 for result_data in results if result_data is None)
+        logger.info(f"Batch processed: {len(results) - failed} succeeded, {failed} failed")
+        
+        archive.seek(0)
+        response = send_file(
+            archive,
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=f"processed_{unique_id}.zip"
+        )
+        response.headers['X-Batch-Count'] = str(len(results))
+        response.headers['X-Batch-Failed'] = str(failed)
+        return response
+        
+    except AdmissionRejected as e:
+        return busy_response(e)
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler with this route's limit
+        raise
+    except Exception as e:
+        logger.error(f"Error processing batch: {str(e)}")
+        return jsonify({'error': f'Internal server error: {str(e)}'}), 500
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """
+    Queue a background removal job and return its id immediately
+    
+    Accepts the same form data as /remove-background. Poll GET /jobs/<id> for
+    status and fetch the image from GET /jobs/<id>/result once finished.
+    """
+    try:
+        if 'image' not in request.files:
+            return jsonify({'error': 'No image file provided'}), 400
+        
+        image_file = request.files['image']
+        if image_file.filename == '':
+            return jsonify({'error': 'No image file selected'}), 400
+        
+        if not validate_image(image_file):
+            return jsonify({'error': 'Invalid image file. Supported formats: PNG, JPG, JPEG, WebP'}), 400
+        
+        options, error = parse_processing_options()
+        if error:
+            return error
+        
+        if not BACKGROUND_PROCESSOR_AVAILABLE or MinimalBackgroundRemover is None:
+            return jsonify({'error': 'Background processing not available. Please check installation.'}), 500
+        
+        manager = get_job_manager()
+        if manager.mode == 'process' and options['background_id']:
+            # Worker processes have no access to the library, so send the original
+            options['background_image_data'] = background_library.get(options['background_id']).data
+            options['background_id'] = None
+        
+        try:
+            job = manager.submit(image_file.read(), options)
+        except QueueFullError as e:
+            response = jsonify({'error': f'Job queue is full: {str(e)}'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        
+        logger.info(f"Queued job {job.id}")
+        body = job.to_dict()
+        body['status_url'] = f"/jobs/{job.id}"
+        body['result_url'] = f"/jobs/{job.id}/result"
+        response = jsonify(body)
+        response.headers['Location'] = body['status_url']
+        return response, 202
+        
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler with this route's limit
+        raise
+    except Exception as e:
+        logger.error(f"Error creating job: {str(e)}")
+        return jsonify({'error': f'Internal server error: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return the status of a job"""
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    
+    body = job.to_dict()
+    body['result_url'] = f"/jobs/{job.id}/result"
+    return jsonify(body), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Return the processed image of a finished job"""
+    job = job_manager.get(job_id) if job_manager else None
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    
+    if job.status == 'failed':
+        return jsonify({'error': job.error, 'status': job.status}), 500
+    
+    if job.status != 'finished':
+        response = jsonify({'status': job.status})
+        response.headers['Retry-After'] = '1'
+        return response, 202
+    
+    result_data = job_manager.get_result(job_id)
+    if result_data is None:
+        return jsonify({'error': 'Job result no longer available'}), 410
+    
+    return send_result(result_data, job.output_format, job.id)
+
+@app.route('/backgrounds', methods=['POST'])
+def register_background():
+    """
+    Register a background image once and return its background_id
+    
+    Form data:
+    - background_image: Background image file (required)
+    """
+    try:
+        background_image = request.files.get('background_image')
+        if not background_image or background_image.filename == '':
+            return jsonify({'error': 'No background_image file provided'}), 400
+        if not validate_image(background_image):
+            return jsonify({'error': 'Invalid background image file. Supported formats: PNG, JPG, JPEG, WebP'}), 400
+        
+        try:
+            asset, created = background_library.register(background_image.read())
+        except LibraryFullError as e:
+            return jsonify({'error': str(e)}), 507
+        
+        return jsonify(asset.to_dict()), 201 if created else 200
+        
+    except RequestEntityTooLarge:
+        # Answered by the 413 handler with this route's limit
+        raise
+    except Exception as e:
+        logger.error(f"Error registering background: {str(e)}")
+        return jsonify({'error': f'Invalid background image: {str(e)}'}), 400
+
+@app.route('/backgrounds', methods=['GET'])
+def list_backgrounds():
+    """List registered backgrounds"""
+    return jsonify({'backgrounds': background_library.list(), 'stats': background_library.stats()}), 200
+
+@app.route('/backgrounds/<background_id>', methods=['GET'])
+def get_background(background_id):
+    """Return metadata for a registered background"""
+    asset = background_library.get(background_id)
+    if asset is None:
+        return jsonify({'error': 'Background not found'}), 404
+    return jsonify(asset.to_dict()), 200
+
+@app.route('/backgrounds/<background_id>', methods=['DELETE'])
+def delete_background(background_id):
+    """Remove a registered background"""
+    if not background_library.delete(background_id):
+        return jsonify({'error': 'Background not found'}), 404
+    return '', 204
+
+@app.route('/results/<shard>/<name>', methods=['GET'])
+def get_result(shard, name):
+    """
+    Serve a stored result by its stable URL
+    
+    The key is a strong ETag: If-None-Match answers 304 and Range requests
+    get partial content. Results never change, so they are cacheable for
+    RESULT_CACHE_MAX_AGE seconds as immutable.
+    """
+    parsed = ResultStore.parse_name(name)
+    mimetype = None
+    if parsed:
+        output_format = normalize_format(parsed[1])
+        mimetype = format_mimetype(output_format) if output_format else RESULT_MIMETYPES.get(parsed[1])
+    if not result_store.enabled or mimetype is None or parsed[0][:2] != shard:
+        return jsonify({'error': 'Result not found'}), 404
+    
+    key, extension = parsed
+    path = result_store.get(key, extension)
+    if path is None:
+        return jsonify({'error': 'Result not found'}), 404
+    
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         etag=key, max_age=RESULT_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Mask cache hit/miss/eviction counters for sizing the cache, plus coalesced requests"""
+    if bg_remover is None or bg_remover.mask_cache is None:
+        return jsonify({'error': 'Mask cache not initialized'}), 503
+    return jsonify(dict(bg_remover.mask_cache.stats(), single_flight=bg_remover.single_flight.stats())), 200
+
+@app.route('/engines', methods=['GET'])
+def engine_stats():
+    """Capabilities, circuit breaker state and health counters of every segmentation engine"""
+    if bg_remover is None:
+        return jsonify({'error': 'Background remover not initialized'}), 503
+    return jsonify(bg_remover.engines.stats()), 200
+
 @app.route('/', methods=['GET'])
 def index():
     """API information endpoint with compatibility status"""
@@ -264,11 +1000,24 @@ def index():
         'processor_type': processor_info,
         'endpoints': {
             'health': '/health',
-            'remove_background': '/remove-background'
+            'livez': '/livez',
+            'readyz': '/readyz',
+            'metrics': '/metrics',
+            'remove_background': '/remove-background',
+            'remove_background_batch': '/remove-background/batch',
+            'jobs': '/jobs',
+            'backgrounds': '/backgrounds',
+            'cache_stats': '/cache/stats',
+            'engines': '/engines',
+            'results': '/results/<key[:2]>/<key>.<ext>'
         },
         'supported_formats': list(ALLOWED_EXTENSIONS),
+        'output_formats': available_formats(),
         'max_file_size': f"{MAX_FILE_SIZE // (1024*1024)}MB",
-        'background_options': ['transparent', 'solid', 'image'],
+        'background_options': ['transparent', 'solid', 'image', 'blur', 'tint'],
+        'models': list(SUPPORTED_MODELS),
+        'default_model': DEFAULT_MODEL,
+        'engines': list(ENGINE_NAMES),
         'compatibility': {
             'python_version': f"{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}",
             'deployment_ready': True
@@ -277,9 +1026,10 @@ def index():
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    """Handle file size limit exceeded"""
+    """Handle file size limit exceeded, reporting the limit of the route that was hit"""
+    limit = request.max_content_length or MAX_FILE_SIZE
     return jsonify({
-        'error': f'File size exceeds maximum limit of {MAX_FILE_SIZE // (1024*1024)}MB'
+        'error': f'File size exceeds maximum limit of {limit // (1024*1024)}MB'
     }), 413
 
 @app.errorhandler(404)
@@ -293,6 +1043,14 @@ def internal_error(error):
     logger.error(f"Internal server error: {str(error)}")
     return jsonify({'error': 'Internal server error'}), 500
 
+# Optional libraries named in WARMUP_BACKENDS are imported now rather than
+# by the first request that needs them
+if WARMUP_BACKENDS:
+    BACKENDS.warm_up(WARMUP_BACKENDS)
+if WARMUP_ON_START:
+    warm_up_models()
+BACKENDS.log_report()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.environ.get('FLASK_ENV', 'development') != 'production'
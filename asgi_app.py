@@ -0,0 +1,358 @@
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Request
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from app import app as flask_app, metrics, MAX_BATCH_CONTENT_LENGTH, RECEIVE_SECONDS_KEY
+
+logger = logging.getLogger(__name__)
+
+# Threads running request handlers (decode, segmentation, encode) and threads
+# for GET/HEAD/OPTIONS requests, so probes and downloads never queue behind
+# image processing
+ASGI_CPU_WORKERS = int(os.environ.get('ASGI_CPU_WORKERS', 0)) or os.cpu_count() or 1
+ASGI_LIGHT_WORKERS = int(os.environ.get('ASGI_LIGHT_WORKERS', 4))
+# Response bytes gathered per executor round trip, sent to the client in ASGI_SEND_CHUNK pieces
+ASGI_RESPONSE_BUFFER = int(os.environ.get('ASGI_RESPONSE_BUFFER', 1024 * 1024))
+ASGI_SEND_CHUNK = int(os.environ.get('ASGI_SEND_CHUNK', 64 * 1024))
+
+# Upload limits of routes that raise MAX_CONTENT_LENGTH themselves
+CONTENT_LIMITS = {'/remove-background/batch': MAX_BATCH_CONTENT_LENGTH}
+LIGHT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# WSGI environ key holding (form, files) parsed while the upload arrived
+PARSED_FORM_KEY = 'bgremoval.parsed_form'
+
+
+class ParsedFormRequest(Request):
+    """Flask request that uses multipart data parsed by the ASGI server instead of re-reading the body"""
+
+    def _load_form_data(self):
+        parsed = self.environ.get(PARSED_FORM_KEY)
+        if parsed is None or 'form' in self.__dict__:
+            return super()._load_form_data()
+        d = self.__dict__
+        d['stream'], d['form'], d['files'] = io.BytesIO(), parsed[0], parsed[1]
+
+
+class MultipartCollector:
+    """
+    Incremental multipart/form-data parser fed body chunks as they arrive
+
+    Text fields are decoded like werkzeug's parser does; files are kept in
+    memory, which the upload limit bounds. Raises RequestEntityTooLarge when a
+    field exceeds max_form_memory_size or there are too many parts, and
+    ValueError on malformed input.
+    """
+
+    def __init__(self, boundary, max_form_memory_size=None, max_parts=None):
+        self.max_form_memory_size = max_form_memory_size
+        self._decoder = MultipartDecoder(boundary, max_form_memory_size, max_parts=max_parts)
+        self._fields = []
+        self._files = []
+        self._part = None
+        self._container = None
+        self._field_size = 0
+        self.finished = False
+
+    def feed(self, data):
+        """Parse one body chunk; None marks the end of the body"""
+        self._decoder.receive_data(data)
+        event = self._decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, (Field, File)):
+                self._part = event
+                self._container = [] if isinstance(event, Field) else io.BytesIO()
+                self._field_size = 0
+            elif isinstance(event, Data):
+                self._write(event)
+            event = self._decoder.next_event()
+        if isinstance(event, Epilogue):
+            self.finished = True
+
+    def result(self):
+        """(form, files) multi dicts; raises ValueError if the body ended early"""
+        if not self.finished:
+            raise ValueError('Multipart body ended before its closing boundary')
+        return MultiDict(self._fields), MultiDict(self._files)
+
+    def _write(self, event):
+        part = self._part
+        if isinstance(part, Field):
+            self._field_size += len(event.data)
+            if self.max_form_memory_size is not None and self._field_size > self.max_form_memory_size:
+                raise RequestEntityTooLarge()
+            self._container.append(event.data)
+        else:
+            self._container.write(event.data)
+        if event.more_data:
+            return
+        if isinstance(part, Field):
+            charset = parse_options_header(part.headers.get('content-type', ''))[1].get('charset', 'utf-8')
+            self._fields.append((part.name, b''.join(self._container).decode(charset, 'replace')))
+        else:
+            self._container.seek(0)
+            self._files.append((part.name, FileStorage(self._container, part.filename, part.name,
+                                                       headers=part.headers)))
+
+
+class AsgiBridge:
+    """
+    Serves the Flask app over ASGI with uploads and downloads handled on the event loop
+
+    The request body is read (and multipart uploads parsed) as it arrives,
+    so slow clients hold no thread. The handler then runs in a bounded
+    thread pool: ASGI_CPU_WORKERS threads for requests that may process
+    images, ASGI_LIGHT_WORKERS for GET/HEAD/OPTIONS. Its response is gathered
+    from the handler up to ASGI_RESPONSE_BUFFER bytes at a time and streamed
+    back from the event loop.
+    """
+
+    def __init__(self, wsgi_app, cpu_workers=ASGI_CPU_WORKERS, light_workers=ASGI_LIGHT_WORKERS,
+                 content_limits=CONTENT_LIMITS):
+        self.wsgi_app = wsgi_app
+        self.cpu_executor = ThreadPoolExecutor(cpu_workers, thread_name_prefix='asgi-cpu')
+        self.light_executor = ThreadPoolExecutor(light_workers, thread_name_prefix='asgi-light')
+        self.cpu_workers = cpu_workers
+        self.content_limits = dict(content_limits)
+
+        self.connections = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.disconnected = 0
+        self._executor_pending = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise RuntimeError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        self.connections += 1
+        try:
+            await self._handle(scope, receive, send)
+        finally:
+            self.connections -= 1
+
+    def stats(self):
+        return {
+            'connections': self.connections,
+            'executor_pending': self._executor_pending,
+            'cpu_workers': self.cpu_workers,
+            'dispatched': self.dispatched,
+            'rejected': self.rejected,
+            'disconnected': self.disconnected,
+        }
+
+    def content_limit(self, path):
+        return self.content_limits.get(path.rstrip('/') or '/', self.wsgi_app.config['MAX_CONTENT_LENGTH'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.cpu_executor.shutdown)
+                await loop.run_in_executor(None, self.light_executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _handle(self, scope, receive, send):
+        headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            headers[name] = f"{headers[name]},{value.decode('latin-1')}" if name in headers else value.decode('latin-1')
+
+        limit = self.content_limit(scope['path'])
+        declared = headers.get('content-length')
+        if limit and declared and declared.isdigit() and int(declared) > limit:
+            return await self._reject(send, 413, f'File size exceeds maximum limit of {limit // (1024 * 1024)}MB')
+
+        receive_start = time.perf_counter()
+        try:
+            body = await self._read_body(receive, headers, limit)
+        except RequestEntityTooLarge:
+            return await self._reject(send, 413, f'File size exceeds maximum limit of {limit // (1024 * 1024)}MB')
+        except ValueError as e:
+            return await self._reject(send, 400, f'Malformed upload: {e}')
+        if body is None:
+            self.disconnected += 1
+            return
+
+        environ = self._environ(scope, headers, body)
+        # The handler's 'receive' stage only sees the form lookup; the upload was read here
+        environ[RECEIVE_SECONDS_KEY] = time.perf_counter() - receive_start
+        executor = self.light_executor if scope['method'] in LIGHT_METHODS else self.cpu_executor
+        loop = asyncio.get_running_loop()
+        self.dispatched += 1
+        self._executor_pending += 1
+        try:
+            status, response_headers, chunks, iterator = await loop.run_in_executor(executor, self._start, environ)
+        finally:
+            self._executor_pending -= 1
+
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response_headers],
+            })
+            while True:
+                for chunk in chunks:
+                    for offset in range(0, len(chunk), ASGI_SEND_CHUNK):
+                        await send({'type': 'http.response.body', 'body': chunk[offset:offset + ASGI_SEND_CHUNK],
+                                    'more_body': True})
+                if iterator is None:
+                    break
+                chunks, iterator = await loop.run_in_executor(self.light_executor, self._gather, iterator)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if iterator is not None and hasattr(iterator, 'close'):
+                await loop.run_in_executor(self.light_executor, iterator.close)
+
+    async def _read_body(self, receive, headers, limit):
+        """
+        Receive the whole body, returning (bytes, parsed form, bytes received) or None on disconnect
+
+        multipart/form-data is parsed chunk by chunk as it arrives and
+        returned as (form, files) instead of bytes; other bodies are buffered.
+        """
+        mimetype, options = parse_options_header(headers.get('content-type', ''))
+        collector = None
+        if mimetype == 'multipart/form-data':
+            boundary = options.get('boundary', '').encode('latin-1')
+            if not boundary:
+                raise ValueError('multipart/form-data without a boundary')
+            collector = MultipartCollector(boundary, self.wsgi_app.config.get('MAX_FORM_MEMORY_SIZE'),
+                                           self.wsgi_app.config.get('MAX_FORM_PARTS'))
+
+        received = 0
+        buffer = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            data = message.get('body', b'')
+            received += len(data)
+            if limit and received > limit:
+                raise RequestEntityTooLarge()
+            if data:
+                if collector is not None:
+                    collector.feed(data)
+                else:
+                    buffer.append(data)
+            if not message.get('more_body', False):
+                break
+
+        if collector is not None:
+            collector.feed(None)
+            return None, collector.result(), received
+        return b''.join(buffer), None, received
+
+    def _environ(self, scope, headers, body):
+        data, parsed, length = body
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(data or b''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            if name == 'content-type':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'content-length':
+                environ[f"HTTP_{name.upper().replace('-', '_')}"] = value
+        # The length actually received, so handlers and logs see the upload size
+        environ['CONTENT_LENGTH'] = str(length)
+        if parsed is not None:
+            environ[PARSED_FORM_KEY] = parsed
+        return environ
+
+    def _start(self, environ):
+        """Run the WSGI app (in an executor thread); returns (status, headers, first chunks, rest or None)"""
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'], response['headers'] = status, headers
+            return written.append
+
+        iterator = iter(self.wsgi_app(environ, start_response))
+        chunks, rest = self._gather(iterator)
+        return response['status'], response['headers'], written + chunks, rest
+
+    def _gather(self, iterator):
+        """Read up to ASGI_RESPONSE_BUFFER bytes of a response; returns (chunks, iterator or None when done)"""
+        chunks = []
+        size = 0
+        for chunk in iterator:
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+            if size >= ASGI_RESPONSE_BUFFER:
+                return chunks, iterator
+        if hasattr(iterator, 'close'):
+            iterator.close()
+        return chunks, None
+
+    async def _reject(self, send, status, message):
+        self.rejected += 1
+        body = json.dumps({'error': message}).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode('latin-1')),
+                                (b'connection', b'close')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+flask_app.request_class = ParsedFormRequest
+app = AsgiBridge(flask_app)
+
+
+def collect_asgi_metrics():
+    stats = app.stats()
+    yield ('bgremoval_asgi_connections', 'gauge', 'HTTP requests open on the ASGI server', stats['connections'])
+    yield ('bgremoval_asgi_executor_pending', 'gauge', 'Requests queued for or running in a handler thread',
+           stats['executor_pending'])
+    yield ('bgremoval_asgi_rejected_total', 'counter', 'Uploads refused before reaching a handler', stats['rejected'])
+    yield ('bgremoval_asgi_disconnected_total', 'counter', 'Clients that left while uploading', stats['disconnected'])
+
+
+metrics.register_collector(collect_asgi_metrics)
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('The ASGI serving mode needs uvicorn: pip install uvicorn')
+    # ProxyFix in app.py already applies X-Forwarded-* headers
+    uvicorn.run(app, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), proxy_headers=False)
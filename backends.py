@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import importlib
+import importlib.util
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Optional libraries behind each backend, imported together on first use;
+# the first module is the one handed to callers
+BACKEND_MODULES = {
+    'cv2': ('cv2',),
+    'scipy': ('scipy.ndimage',),
+    'skimage': ('skimage.filters', 'skimage.segmentation', 'skimage.morphology', 'skimage.measure'),
+    'onnxruntime': ('onnxruntime',),
+    'rembg': ('rembg', 'rembg.bg'),
+}
+
+# Backends imported at startup instead of on first use: comma-separated
+# names, or 'auto' for the one the local engines and mask refinement prefer
+WARMUP_BACKENDS = os.environ.get('WARMUP_BACKENDS', '').lower()
+
+# Order the local engines and the mask refinement box filter prefer
+PREFERRED_BACKENDS = ('cv2', 'skimage', 'scipy')
+
+
+class BackendRegistry:
+    """
+    Optional libraries imported on first use, with their import times
+
+    installed() only looks the package up, so checking whether an engine could
+    run costs nothing. load() imports the backend's modules once, records how
+    long that took, and remembers failures so a broken install (e.g. cv2
+    without libGL) is reported as unavailable afterwards.
+    """
+
+    def __init__(self, modules=BACKEND_MODULES):
+        self.modules = dict(modules)
+        self._lock = threading.Lock()
+        self._installed = {}
+        self._loaded = {}
+        self._errors = {}
+        self._seconds = {}
+
+    def installed(self, name):
+        """Whether the backend's package can be found, without importing it"""
+        if name not in self._installed:
+            package = self.modules[name][0].split('.')[0]
+            try:
+                self._installed[name] = importlib.util.find_spec(package) is not None
+            except (ImportError, ValueError):
+                self._installed[name] = False
+        return self._installed[name]
+
+    def available(self, name):
+        """Whether the backend is installed and has not failed to import"""
+        return name not in self._errors and self.installed(name)
+
+    def loaded(self, name):
+        return name in self._loaded
+
+    def load(self, name):
+        """Import a backend on first use and return its first module; raises ImportError"""
+        module = self._loaded.get(name)
+        if module is not None:
+            return module
+        with self._lock:
+            if name in self._loaded:
+                return self._loaded[name]
+            if name in self._errors:
+                raise ImportError(self._errors[name])
+            start = time.perf_counter()
+            try:
+                modules = [importlib.import_module(module_name) for module_name in self.modules[name]]
+            except Exception as e:
+                # Anything raised while importing (missing shared libraries too) means unavailable
+                self._errors[name] = f"{type(e).__name__}: {e}"
+                self._seconds[name] = time.perf_counter() - start
+                logger.warning(f"Backend {name} failed to import: {e}")
+                raise ImportError(self._errors[name]) from e
+            self._seconds[name] = time.perf_counter() - start
+            self._loaded[name] = modules[0]
+            logger.info(f"Imported backend {name} in {self._seconds[name] * 1000:.0f}ms")
+            return modules[0]
+
+    def optional(self, name):
+        """The backend's first module, or None when it is not installed or fails to import"""
+        if not self.available(name):
+            return None
+        try:
+            return self.load(name)
+        except ImportError:
+            return None
+
+    def warm_up(self, names):
+        """Import backends ahead of use; 'auto' picks the first available preferred backend"""
+        if isinstance(names, str):
+            names = [n.strip() for n in names.split(',') if n.strip()]
+        if 'auto' in names:
+            names = [n for n in names if n != 'auto']
+            names.extend(next(([n] for n in PREFERRED_BACKENDS if self.available(n)), []))
+        for name in names:
+            if name not in self.modules:
+                logger.warning(f"Skipping warm-up of unknown backend: {name}")
+                continue
+            self.optional(name)
+
+    def report(self):
+        """Per-backend state and import time in milliseconds"""
+        report = {}
+        for name in self.modules:
+            seconds = self._seconds.get(name)
+            report[name] = {
+                'installed': self.installed(name),
+                'loaded': name in self._loaded,
+                'import_ms': round(seconds * 1000, 1) if seconds is not None else None,
+                'error': self._errors.get(name),
+            }
+        return report
+
+    def log_report(self):
+        for name, state in self.report().items():
+            if state['loaded']:
+                detail = f"imported in {state['import_ms']}ms"
+            elif state['error']:
+                detail = f"failed to import ({state['error']})"
+            else:
+                detail = 'deferred' if state['installed'] else 'not installed'
+            logger.info(f"Backend {name}: {detail}")
+
+
+# Registry shared by every module in the process
+BACKENDS = BackendRegistry()
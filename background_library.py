@@ -0,0 +1,208 @@
+import os
+import io
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment
+MAX_BACKGROUNDS = int(os.environ.get('MAX_BACKGROUNDS', 50))
+BACKGROUND_VARIANT_CACHE_BYTES = int(os.environ.get('BACKGROUND_VARIANT_CACHE_BYTES', 256 * 1024 * 1024))
+BACKGROUND_DIR = os.environ.get('BACKGROUND_DIR') or None
+
+
+class LibraryFullError(Exception):
+    """Raised when registering a background would exceed MAX_BACKGROUNDS"""
+
+
+class BackgroundAsset:
+    """A registered background: its original bytes and the decoded RGB image"""
+
+    def __init__(self, background_id, data, image, created_at=None):
+        self.id = background_id
+        self.data = data
+        self.image = image
+        self.created_at = created_at or time.time()
+
+    def to_dict(self):
+        return {
+            'background_id': self.id,
+            'width': self.image.width,
+            'height': self.image.height,
+            'size_bytes': len(self.data),
+            'created_at': self.created_at,
+        }
+
+
+class BackgroundLibrary:
+    """Registered background images with an LRU of variants already resized to target sizes
+
+    Backgrounds are uploaded once and referenced by id. Each is decoded to RGB
+    at registration, and resized copies are cached per target size as uint8
+    arrays, so compositing with a registered background needs no decode,
+    resample or conversion.
+    Originals are optionally persisted under storage_dir and reloaded on start.
+    """
+
+    def __init__(self, max_backgrounds=MAX_BACKGROUNDS, max_variant_bytes=BACKGROUND_VARIANT_CACHE_BYTES,
+                 storage_dir=BACKGROUND_DIR):
+        self.max_backgrounds = max_backgrounds
+        self.max_variant_bytes = max_variant_bytes
+        self.storage_dir = storage_dir
+
+        self._assets = {}
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+        self.variant_bytes = 0
+        self.variant_hits = 0
+        self.variant_misses = 0
+        self.variant_evictions = 0
+
+        if self.storage_dir:
+            os.makedirs(self.storage_dir, exist_ok=True)
+            self._load_stored()
+
+    @staticmethod
+    def make_id(data):
+        return hashlib.sha256(data).hexdigest()[:24]
+
+    def register(self, data):
+        """Decode and store a background; returns (asset, created)"""
+        background_id = self.make_id(data)
+        with self._lock:
+            asset = self._assets.get(background_id)
+            if asset is not None:
+                return asset, False
+            if len(self._assets) >= self.max_backgrounds:
+                raise LibraryFullError(f"Background library is full ({self.max_backgrounds} backgrounds)")
+
+        image = self._decode(data)
+        asset = BackgroundAsset(background_id, data, image)
+        with self._lock:
+            existing = self._assets.get(background_id)
+            if existing is not None:
+                return existing, False
+            # Other uploads may have filled the library while this one was decoded
+            if len(self._assets) >= self.max_backgrounds:
+                raise LibraryFullError(f"Background library is full ({self.max_backgrounds} backgrounds)")
+            self._assets[background_id] = asset
+
+        if self.storage_dir:
+            try:
+                with open(self._storage_path(background_id), 'wb') as f:
+                    f.write(data)
+            except OSError as e:
+                logger.warning(f"Failed to persist background {background_id}: {e}")
+
+        logger.info(f"Registered background {background_id} ({image.width}x{image.height})")
+        return asset, True
+
+    def get(self, background_id):
+        with self._lock:
+            return self._assets.get(background_id)
+
+    def list(self):
+        with self._lock:
+            return [asset.to_dict() for asset in self._assets.values()]
+
+    def delete(self, background_id):
+        """Remove a background and its cached variants; returns False if unknown"""
+        with self._lock:
+            if self._assets.pop(background_id, None) is None:
+                return False
+            for key in [key for key in self._variants if key[0] == background_id]:
+                self.variant_bytes -= self._variant_size(self._variants.pop(key))
+
+        if self.storage_dir:
+            try:
+                os.remove(self._storage_path(background_id))
+            except OSError:
+                pass
+        logger.info(f"Deleted background {background_id}")
+        return True
+
+    def get_variant(self, background_id, size):
+        """Return the background resized to size as an (H, W, 3) uint8 array, or None if the id is unknown"""
+        key = (background_id, tuple(size))
+        with self._lock:
+            variant = self._variants.get(key)
+            if variant is not None:
+                self._variants.move_to_end(key)
+                self.variant_hits += 1
+                return variant
+            asset = self._assets.get(background_id)
+            if asset is None:
+                return None
+            self.variant_misses += 1
+
+        if asset.image.size == key[1]:
+            variant = asset.image
+        else:
+            variant = asset.image.resize(key[1], Image.Resampling.LANCZOS)
+        if NUMPY_AVAILABLE:
+            variant = np.asarray(variant)
+        variant_size = self._variant_size(variant)
+
+        with self._lock:
+            if variant_size <= self.max_variant_bytes and key not in self._variants:
+                self._variants[key] = variant
+                self.variant_bytes += variant_size
+                while self.variant_bytes > self.max_variant_bytes:
+                    _, evicted = self._variants.popitem(last=False)
+                    self.variant_bytes -= self._variant_size(evicted)
+                    self.variant_evictions += 1
+        return variant
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backgrounds': len(self._assets),
+                'max_backgrounds': self.max_backgrounds,
+                'variants': len(self._variants),
+                'variant_bytes': self.variant_bytes,
+                'max_variant_bytes': self.max_variant_bytes,
+                'variant_hits': self.variant_hits,
+                'variant_misses': self.variant_misses,
+                'variant_evictions': self.variant_evictions,
+            }
+
+    @staticmethod
+    def _variant_size(variant):
+        # Variants stay PIL images only when NumPy is missing; both are RGB
+        return variant.width * variant.height * 3 if isinstance(variant, Image.Image) else variant.nbytes
+
+    def _decode(self, data):
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        return image.convert('RGB')
+
+    def _storage_path(self, background_id):
+        return os.path.join(self.storage_dir, f"{background_id}.bg")
+
+    def _load_stored(self):
+        """Reload backgrounds persisted by a previous process"""
+        for name in sorted(os.listdir(self.storage_dir)):
+            if not name.endswith('.bg'):
+                continue
+            path = os.path.join(self.storage_dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                background_id = self.make_id(data)
+                self._assets[background_id] = BackgroundAsset(
+                    background_id, data, self._decode(data), os.path.getmtime(path)
+                )
+            except Exception as e:
+                logger.warning(f"Failed to load stored background {path}: {e}")
+        logger.info(f"Loaded {len(self._assets)} stored backgrounds from {self.storage_dir}")
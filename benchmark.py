@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Benchmark every segmentation engine across image sizes
+
+Runs rembg with each supported model and each local fallback engine on
+synthetic subjects (with exact ground truth) and on the photos in
+attached_assets/, at long edges from 256 to 6000 px. Each engine/image/size
+case runs in a fresh process so its peak RSS is its own. Results (p50/p95
+latency, peak RSS, mask IoU) are written as JSON, and a previous run can be
+passed with --compare to flag regressions.
+
+rembg models can also be compared across model file variants from a local
+directory (see ort_tuning.py) and onnxruntime settings, on the CPU only:
+
+    python benchmark.py --sizes 256,1024 --engines opencv,scipy --output bench.json
+    python benchmark.py --compare bench.json
+    python benchmark.py --models u2net --model-dir models --prepare-variants \
+        --variants fp32,int8,opt --ort-threads 1,4 --graph-opt basic,all --cpu-only
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (256, 512, 1024, 2048, 4000, 6000)
+SYNTHETIC_SUBJECTS = ('plain', 'gradient', 'textured')
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attached_assets')
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Regressions flagged by --compare
+LATENCY_REGRESSION = 0.20
+IOU_REGRESSION = 0.02
+
+
+def draw_subject(size, background='white'):
+    """A red disc over a color or same-size RGB image; returns (image, ground-truth mask)"""
+    if isinstance(background, Image.Image):
+        image = background.copy()
+    else:
+        image = Image.new('RGB', (size, size), background)
+    mask = Image.new('L', (size, size), 0)
+    scale = size / 300
+    box = [round(100 * scale), round(100 * scale), round(200 * scale), round(200 * scale)]
+    ImageDraw.Draw(image).ellipse(box, fill='red', outline='darkred', width=max(1, round(3 * scale)))
+    ImageDraw.Draw(mask).ellipse(box, fill=255)
+    return image, mask
+
+
+def synthetic_subject(kind, size):
+    """The disc over a plain, gradient or textured background; returns (image, mask)"""
+    if kind == 'plain':
+        return draw_subject(size)
+    if kind == 'gradient':
+        ramp = np.linspace(60, 230, size, dtype=np.float32)
+        background = np.stack([
+            np.broadcast_to(ramp[None, :], (size, size)),
+            np.broadcast_to(ramp[:, None], (size, size)),
+            np.full((size, size), 180, dtype=np.float32),
+        ], axis=-1).astype(np.uint8)
+        image, mask = draw_subject(size, Image.fromarray(background, 'RGB'))
+        # A second, rectangular part of the subject
+        scale = size / 300
+        box = [round(40 * scale), round(210 * scale), round(110 * scale), round(270 * scale)]
+        ImageDraw.Draw(image).rectangle(box, fill=(20, 40, 160))
+        ImageDraw.Draw(mask).rectangle(box, fill=255)
+        return image, mask
+    if kind == 'textured':
+        rng = np.random.default_rng(size)
+        noise = rng.normal(170, 35, (size, size, 3)).clip(0, 255).astype(np.uint8)
+        return draw_subject(size, Image.fromarray(noise, 'RGB'))
+    raise ValueError(f"Unknown synthetic subject: {kind}")
+
+
+def photo_subject(path, size):
+    """A photo resized to the long edge, with <name>_mask.png as ground truth when present"""
+    image = ImageOps.exif_transpose(Image.open(path)).convert('RGB')
+    scale = size / max(image.size)
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    image = image.resize(target, Image.Resampling.LANCZOS)
+
+    mask_path = os.path.splitext(path)[0] + '_mask.png'
+    mask = None
+    if os.path.exists(mask_path):
+        mask = Image.open(mask_path).convert('L').resize(target, Image.Resampling.NEAREST)
+    return image, mask
+
+
+def list_photos(asset_dir=ASSET_DIR):
+    return sorted(
+        path for path in glob.glob(os.path.join(asset_dir, '*'))
+        if path.lower().endswith(PHOTO_EXTENSIONS) and not path.lower().endswith('_mask.png')
+    )
+
+
+def mask_iou(mask, truth):
+    """Intersection over union of two masks thresholded at 50%"""
+    predicted = np.asarray(mask.convert('L')) >= 128
+    expected = np.asarray(truth) >= 128
+    union = np.logical_or(predicted, expected).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(predicted, expected).sum() / union)
+
+
+class _FallbackCounter(logging.Handler):
+    """Counts warnings from engines that silently hand over to another one"""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        if 'fall' in record.getMessage().lower():
+            self.count += 1
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(case):
+    """Run one engine on one image repeatedly; executed in a fresh process"""
+    from minimal_rembg_processor import MinimalBackgroundRemover, FALLBACK_ENGINES
+    from ort_tuning import find_local_model
+
+    engine, subject, size, repeats = case['engine'], case['subject'], case['size'], case['repeats']
+    result = {'engine': case.get('label', engine), 'subject': subject, 'size': size, 'repeats': repeats}
+    if case.get('variant'):
+        result['variant'] = case['variant']
+        result['ort'] = case['ort']
+    stage = 'setup'
+    try:
+        if subject.startswith('photo:'):
+            image, truth = photo_subject(os.path.join(ASSET_DIR, subject[len('photo:'):]), size)
+        else:
+            image, truth = synthetic_subject(subject, size)
+        result['dimensions'] = list(image.size)
+
+        if case.get('variant'):
+            remover = MinimalBackgroundRemover(ort_options=case['ort'], model_dir=case['model_dir'],
+                                               model_variants=[case['variant']])
+        else:
+            remover = MinimalBackgroundRemover()
+        if engine.startswith('rembg:'):
+            model = engine[len('rembg:'):]
+            rembg = remover._get_rembg()
+            if not rembg:
+                raise RuntimeError('rembg is not available')
+            if case.get('model_dir') and find_local_model(case['model_dir'], model, [case['variant']]) is None:
+                raise RuntimeError(f"{model} {case['variant']} variant not found in {case['model_dir']}")
+            session = remover._get_session(model)
+            segment = lambda img: rembg.remove(img, session=session, only_mask=True)
+        else:
+            method = getattr(remover, FALLBACK_ENGINES[engine][0])
+            segment = lambda img: method(img.convert('RGBA'))
+
+        counter = _FallbackCounter()
+        logging.getLogger('minimal_rembg_processor').addHandler(counter)
+        result['baseline_rss_mb'] = _peak_rss_mb()
+
+        # The first run pays session creation and allocator warm-up
+        stage = 'run'
+        start = time.perf_counter()
+        mask = segment(image)
+        result['first_run_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            mask = segment(image)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        result['p50_ms'] = round(float(np.percentile(latencies, 50)), 2)
+        result['p95_ms'] = round(float(np.percentile(latencies, 95)), 2)
+        result['mean_ms'] = round(float(np.mean(latencies)), 2)
+        result['peak_rss_mb'] = _peak_rss_mb()
+        result['iou'] = round(mask_iou(mask, truth), 4) if truth is not None else None
+        result['fell_back'] = counter.count > 0
+    except Exception as e:
+        result['error'] = str(e)
+        result['error_stage'] = stage
+    return result
+
+
+def available_engines(models=None):
+    """Engine names runnable in this environment"""
+    from minimal_rembg_processor import (SUPPORTED_MODELS, NUMPY_AVAILABLE, SCIPY_AVAILABLE,
+                                         SKIMAGE_AVAILABLE, CV2_AVAILABLE)
+    engines = []
+    try:
+        import rembg  # noqa: F401
+        engines.extend(f"rembg:{model}" for model in (models or SUPPORTED_MODELS))
+    except Exception as e:
+        logger.warning(f"rembg unavailable, skipping its models: {e}")
+    if CV2_AVAILABLE and NUMPY_AVAILABLE:
+        engines.append('opencv')
+    if SKIMAGE_AVAILABLE and NUMPY_AVAILABLE:
+        engines.append('skimage')
+    if SCIPY_AVAILABLE and NUMPY_AVAILABLE:
+        engines.append('scipy')
+    if NUMPY_AVAILABLE:
+        engines.append('advanced_pil')
+    engines.append('basic_pil')
+    return engines
+
+
+def variant_cases(engine, args):
+    """Expand a rembg engine into one case per model variant and onnxruntime setting"""
+    variants = args.variants.split(',') if args.variants else [None]
+    threads = [int(t) for t in args.ort_threads.split(',')] if args.ort_threads else [0]
+    levels = args.graph_opt.split(',') if args.graph_opt else ['all']
+    tuned = args.variants or args.ort_threads or args.graph_opt or args.cpu_only
+    if not engine.startswith('rembg:') or not tuned:
+        return [{'engine': engine}]
+
+    cases = []
+    for variant in variants:
+        for thread_count in threads:
+            for level in levels:
+                ort = {'intra_op_threads': thread_count, 'graph_optimization': level}
+                if args.cpu_only:
+                    ort['providers'] = ['CPUExecutionProvider']
+                label = f"{engine}@{variant or 'download'}/t{thread_count}/{level}"
+                cases.append({'engine': engine, 'label': label, 'variant': variant or 'download',
+                              'model_dir': args.model_dir if variant else '', 'ort': ort})
+    return cases
+
+
+def prepare_variants(models, model_dir, variants):
+    """Write the fp32, int8 and opt files of each model into model_dir from rembg's download"""
+    import shutil
+    from minimal_rembg_processor import MinimalBackgroundRemover
+    from ort_tuning import variant_filename, quantize_model, optimize_model
+
+    os.makedirs(model_dir, exist_ok=True)
+    for model in models:
+        # An empty model dir makes the session come from rembg's own download
+        session = MinimalBackgroundRemover(model_dir='')._get_session(model)
+        if session is None:
+            raise RuntimeError('rembg is not available')
+        source = str(type(session).download_models())
+        for variant in variants:
+            destination = os.path.join(model_dir, variant_filename(model, variant))
+            if os.path.exists(destination):
+                continue
+            print(f"Writing {destination}")
+            if variant == 'fp32':
+                shutil.copyfile(source, destination)
+            elif variant == 'int8':
+                quantize_model(source, destination)
+            elif variant == 'opt':
+                optimize_model(source, destination)
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    """Return regressions of results against a previous run's results"""
+    previous = {(r['engine'], r['subject'], r['size']): r for r in baseline if 'error' not in r}
+    regressions = []
+    for result in results:
+        before = previous.get((result['engine'], result['subject'], result['size']))
+        if before is None or 'error' in result:
+            continue
+        case = f"{result['engine']} {result['subject']} {result['size']}px"
+        if result['p50_ms'] > before['p50_ms'] * (1 + LATENCY_REGRESSION):
+            regressions.append(f"{case}: p50 {before['p50_ms']}ms -> {result['p50_ms']}ms")
+        if result.get('iou') is not None and before.get('iou') is not None \
+                and result['iou'] < before['iou'] - IOU_REGRESSION:
+            regressions.append(f"{case}: IoU {before['iou']} -> {result['iou']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma-separated long edges in pixels')
+    parser.add_argument('--engines', help='comma-separated engines (default: all available)')
+    parser.add_argument('--models', help='comma-separated rembg models (default: all supported)')
+    parser.add_argument('--subjects', help="comma-separated synthetic subjects and 'photos'")
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous results JSON to check for regressions')
+    parser.add_argument('--variants', help='comma-separated rembg model file variants (fp32, int8, opt, ...)')
+    parser.add_argument('--model-dir', default='models', help='directory holding the model file variants')
+    parser.add_argument('--prepare-variants', action='store_true',
+                        help='write the fp32/int8/opt variants into --model-dir before running')
+    parser.add_argument('--ort-threads', help='comma-separated onnxruntime intra-op thread counts')
+    parser.add_argument('--graph-opt', help='comma-separated graph optimization levels (disable, basic, extended, all)')
+    parser.add_argument('--cpu-only', action='store_true', help='run rembg models on the CPU execution provider')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    baseline = None
+    if args.compare:
+        # Read it up front in case --output points at the same file
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    sizes = [int(s) for s in args.sizes.split(',')]
+    models = args.models.split(',') if args.models else None
+    engines = args.engines.split(',') if args.engines else available_engines(models)
+    subjects = args.subjects.split(',') if args.subjects else list(SYNTHETIC_SUBJECTS) + ['photos']
+    if 'photos' in subjects:
+        subjects.remove('photos')
+        subjects.extend(f"photo:{os.path.basename(path)}" for path in list_photos())
+
+    if args.prepare_variants and args.variants:
+        prepare_variants(models or [e[len('rembg:'):] for e in engines if e.startswith('rembg:')],
+                         args.model_dir, args.variants.split(','))
+
+    cases = [dict(variant, subject=subject, size=size, repeats=args.repeats)
+             for engine in engines for variant in variant_cases(engine, args)
+             for subject in subjects for size in sizes]
+    print(f"Running {len(cases)} cases: {len(engines)} engines x {len(subjects)} images x {len(sizes)} sizes")
+
+    # One process per case keeps peak RSS and allocator state independent
+    context = multiprocessing.get_context('spawn')
+    results = []
+    broken_engines = set()
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for case in cases:
+            if case.get('label', case['engine']) in broken_engines:
+                continue
+            result = pool.apply(run_case, (case,))
+            results.append(result)
+            if 'error' in result:
+                # A model that cannot be loaded will not load for the next size either
+                if result['error_stage'] == 'setup' and case['engine'].startswith('rembg:'):
+                    broken_engines.add(case.get('label', case['engine']))
+                print(f"  {result['engine']:<24} {result['subject']:<28} {result['size']:>5}px  error: {result['error']}", flush=True)
+            else:
+                iou = '-' if result['iou'] is None else f"{result['iou']:.3f}"
+                print(f"  {result['engine']:<24} {result['subject']:<28} {result['size']:>5}px  "
+                      f"p50 {result['p50_ms']:>9.1f}ms  p95 {result['p95_ms']:>9.1f}ms  "
+                      f"rss {result['peak_rss_mb']:>7.1f}MB  IoU {iou}"
+                      f"{'  (fell back)' if result['fell_back'] else ''}", flush=True)
+
+    report = {'environment': environment_info(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.compare}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment. A breaker opens once at
+# least ENGINE_BREAKER_MIN_CALLS of the last ENGINE_BREAKER_WINDOW calls were
+# made and ENGINE_BREAKER_ERROR_RATE of them failed; after
+# ENGINE_BREAKER_COOLDOWN seconds it lets trial calls through again
+ENGINE_BREAKER_WINDOW = int(os.environ.get('ENGINE_BREAKER_WINDOW', 20))
+ENGINE_BREAKER_MIN_CALLS = int(os.environ.get('ENGINE_BREAKER_MIN_CALLS', 5))
+ENGINE_BREAKER_ERROR_RATE = float(os.environ.get('ENGINE_BREAKER_ERROR_RATE', 0.5))
+ENGINE_BREAKER_COOLDOWN = float(os.environ.get('ENGINE_BREAKER_COOLDOWN', 30))
+# Consecutive successful trial calls that close a half-open breaker
+ENGINE_BREAKER_TRIAL_CALLS = int(os.environ.get('ENGINE_BREAKER_TRIAL_CALLS', 1))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class NoEngineAvailable(RuntimeError):
+    """Raised when every engine asked for is unavailable, short-circuited or failed"""
+
+
+class EngineUnavailable(NoEngineAvailable):
+    """Raised when a forced engine cannot run here (not installed, model not loadable); names the engine"""
+
+    def __init__(self, message, engine, state):
+        super().__init__(message)
+        self.engine = engine
+        self.state = state
+
+
+class Engine:
+    """
+    A segmentation engine: segment(image) returns an 'L' alpha mask at the image's size
+
+    available() says whether it can run in this process without doing any
+    work; capabilities describe it to callers and planners (kind 'rembg' or
+    'local', whether it is a learned model, batching support, the backend or
+    model it needs).
+    """
+
+    def __init__(self, name, segment, available=None, **capabilities):
+        self.name = name
+        self._segment = segment
+        self._available = available
+        self.capabilities = capabilities
+
+    def available(self):
+        return self._available() if self._available is not None else True
+
+    def segment(self, image):
+        return self._segment(image)
+
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker with per-engine health counters
+
+    Closed: calls go through and their outcomes fill a sliding window.
+    Open: calls are short-circuited until the cooldown has passed.
+    Half-open: up to trial_calls calls at a time are let through; that many
+    successes close the breaker, any failure opens it again.
+    """
+
+    def __init__(self, window=ENGINE_BREAKER_WINDOW, min_calls=ENGINE_BREAKER_MIN_CALLS,
+                 error_rate=ENGINE_BREAKER_ERROR_RATE, cooldown=ENGINE_BREAKER_COOLDOWN,
+                 trial_calls=ENGINE_BREAKER_TRIAL_CALLS):
+        self.min_calls = max(1, min_calls)
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.trial_calls = max(1, trial_calls)
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=max(1, window))
+        self._state = CLOSED
+        self._opened_at = None
+        self._trials = 0
+        self._trial_successes = 0
+
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.short_circuited = 0
+        self.openings = 0
+        self.seconds = 0.0
+        self.last_error = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def blocking(self):
+        """Whether a call made now would be short-circuited (no side effects)"""
+        with self._lock:
+            state = self._current_state()
+            return state == OPEN or (state == HALF_OPEN and self._trials >= self.trial_calls)
+
+    def allow(self):
+        """Claim permission for one call; False means skip this engine"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._trials < self.trial_calls:
+                self._trials += 1
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.calls += 1
+            self.successes += 1
+            self.seconds += seconds
+            if self._state == HALF_OPEN:
+                self._trials = max(0, self._trials - 1)
+                self._trial_successes += 1
+                if self._trial_successes >= self.trial_calls:
+                    logger.info("Circuit breaker closed after successful trial calls")
+                    self._close()
+            elif self._state == CLOSED:
+                self._outcomes.append(True)
+
+    def record_failure(self, error, seconds=0.0):
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self.seconds += seconds
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self._state == HALF_OPEN:
+                self._trials = max(0, self._trials - 1)
+                self._open()
+            elif self._state == CLOSED:
+                self._outcomes.append(False)
+                failed = self._outcomes.count(False)
+                if len(self._outcomes) >= self.min_calls and failed / len(self._outcomes) >= self.error_rate:
+                    self._open()
+
+    def trip(self, error, seconds=0.0):
+        """Record a failure that rules the engine out (e.g. its model cannot load) and open at once"""
+        with self._lock:
+            self.calls += 1
+            self.failures += 1
+            self.seconds += seconds
+            self.last_error = f"{type(error).__name__}: {error}"
+            self._trials = max(0, self._trials - 1)
+            self._open()
+
+    def reset(self):
+        with self._lock:
+            self._close()
+
+    def stats(self):
+        with self._lock:
+            window = len(self._outcomes)
+            return {
+                'state': self._current_state(),
+                'calls': self.calls,
+                'successes': self.successes,
+                'failures': self.failures,
+                'short_circuited': self.short_circuited,
+                'openings': self.openings,
+                'error_rate': round(self._outcomes.count(False) / window, 3) if window else 0.0,
+                'mean_ms': round(self.seconds / self.calls * 1000, 2) if self.calls else None,
+                'last_error': self.last_error,
+            }
+
+    def _current_state(self):
+        """State with an expired cooldown read as half-open (lock must be held)"""
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self._state = HALF_OPEN
+            self._trials = 0
+            self._trial_successes = 0
+        return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self.openings += 1
+
+    def _close(self):
+        self._state = CLOSED
+        self._outcomes.clear()
+        self._trials = 0
+        self._trial_successes = 0
+
+
+class EngineRegistry:
+    """Registered engines, each behind its own circuit breaker"""
+
+    def __init__(self, breaker_factory=CircuitBreaker):
+        self._engines = {}
+        self.breakers = {}
+        self._breaker_factory = breaker_factory
+
+    def register(self, engine):
+        self._engines[engine.name] = engine
+        self.breakers[engine.name] = self._breaker_factory()
+        return engine
+
+    def get(self, name):
+        return self._engines.get(name)
+
+    def names(self):
+        return list(self._engines)
+
+    def usable(self, name):
+        """Whether an engine can run and its breaker would let a call through"""
+        engine = self._engines.get(name)
+        return engine is not None and engine.available() and not self.breakers[name].blocking()
+
+    def allow(self, name):
+        return self.breakers[name].allow()
+
+    def record_success(self, name, seconds):
+        self.breakers[name].record_success(seconds)
+
+    def record_failure(self, name, error, seconds=0.0):
+        breaker = self.breakers[name]
+        was_open = breaker.state == OPEN
+        breaker.record_failure(error, seconds)
+        if not was_open and breaker.state == OPEN:
+            logger.warning(f"Circuit breaker for {name} opened: {breaker.last_error}")
+
+    def trip(self, name, error, seconds=0.0):
+        self.breakers[name].trip(error, seconds)
+        logger.warning(f"Circuit breaker for {name} opened: {self.breakers[name].last_error}")
+
+    def run(self, names, image, forced=False):
+        """
+        Segment with the first of names that is available and allowed, returning (mask, engine name)
+
+        A failing engine is recorded against its breaker and the next one is
+        tried. With forced the single engine is called even when its breaker
+        is open, and its exception propagates; EngineUnavailable when it
+        cannot run at all. Raises NoEngineAvailable when no engine produced a
+        mask.
+        """
+        errors = []
+        for name in names:
+            engine = self._engines.get(name)
+            if engine is None:
+                raise ValueError(f"Unknown segmentation engine: {name}")
+            if not engine.available():
+                if forced:
+                    raise EngineUnavailable(f"Segmentation engine {name} is not available", name,
+                                            self.breakers[name].state)
+                continue
+            if not forced and not self.allow(name):
+                logger.info(f"Skipping {name}: circuit breaker open")
+                continue
+
+            start = time.perf_counter()
+            try:
+                mask = engine.segment(image)
+            except Exception as e:
+                self.record_failure(name, e, time.perf_counter() - start)
+                if forced and isinstance(e, NoEngineAvailable) and not isinstance(e, EngineUnavailable):
+                    raise EngineUnavailable(str(e), name, self.breakers[name].state) from e
+                if forced:
+                    raise
+                logger.warning(f"Segmentation with {name} failed: {e}")
+                errors.append(f"{name}: {e}")
+                continue
+            self.record_success(name, time.perf_counter() - start)
+            return mask, name
+        raise NoEngineAvailable('No segmentation engine available' + (f" ({'; '.join(errors)})" if errors else ''))
+
+    def stats(self):
+        """Capabilities, availability and breaker health of every engine"""
+        return {
+            name: dict(self.breakers[name].stats(), available=engine.available(),
+                       capabilities=engine.capabilities)
+            for name, engine in self._engines.items()
+        }
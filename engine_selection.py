@@ -0,0 +1,176 @@
+import os
+import json
+import logging
+import threading
+import statistics
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Quality tiers a request can ask for, best first
+QUALITY_TIERS = ('best', 'balanced', 'fast')
+
+# Segmentation plans from best to fastest as (tier, model or engine, proxy_edge).
+# A request for a tier starts at its first rung; a latency budget walks down
+# from there to the first rung predicted to fit.
+REMBG_LADDER = (
+    ('best', 'isnet-general-use', 0),
+    ('best', 'isnet-general-use', 2048),
+    ('balanced', 'u2net', 1024),
+    ('balanced', 'u2net', 512),
+    ('fast', 'u2netp', 512),
+    ('fast', 'u2netp', 320),
+)
+FALLBACK_LADDER = (
+    ('best', 'opencv', 1024),
+    ('balanced', 'opencv', 512),
+    ('balanced', 'advanced_pil', 1024),
+    ('fast', 'advanced_pil', 512),
+    ('fast', 'advanced_pil', 256),
+)
+
+# Assumed cost of each engine as (fixed seconds, seconds per megapixel) until
+# requests on this host have been measured. 'refine' is the full-resolution
+# mask upsampling and refinement after proxy segmentation.
+ENGINE_COST_PRIORS = {
+    'rembg:u2netp': (0.15, 0.02),
+    'rembg:u2net': (0.6, 0.02),
+    'rembg:isnet-general-use': (1.6, 0.03),
+    'fallback:opencv': (0.05, 2.5),
+    'fallback:advanced_pil': (0.01, 0.15),
+    'refine': (0.0, 0.08),
+}
+DEFAULT_COST_PRIOR = (0.5, 0.5)
+
+# Recent observations kept per engine
+THROUGHPUT_WINDOW = int(os.environ.get('THROUGHPUT_WINDOW', 50))
+
+# Optional benchmark.py results used to seed the priors for this host
+ENGINE_COST_FILE = os.environ.get('ENGINE_COST_FILE')
+
+
+def _prior_seconds(prior, pixels):
+    fixed, per_megapixel = prior
+    return fixed + per_megapixel * pixels / 1e6
+
+
+def load_benchmark_priors(path):
+    """
+    Fit (fixed seconds, seconds per megapixel) per engine from benchmark.py results
+
+    Engines measured at a single size keep the default fixed cost and get
+    their per-megapixel cost from the remainder.
+    """
+    with open(path) as f:
+        results = json.load(f)['results']
+
+    samples = {}
+    for result in results:
+        if 'error' in result or 'p50_ms' not in result:
+            continue
+        engine = result['engine']
+        if not engine.startswith('rembg:'):
+            engine = f"fallback:{engine}"
+        width, height = result['dimensions']
+        samples.setdefault(engine, []).append((width * height / 1e6, result['p50_ms'] / 1000))
+
+    priors = {}
+    for engine, points in samples.items():
+        sizes = {megapixels for megapixels, _ in points}
+        if len(sizes) > 1:
+            # Least-squares line through (megapixels, seconds)
+            mean_x = statistics.fmean(x for x, _ in points)
+            mean_y = statistics.fmean(y for _, y in points)
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x, _ in points)
+            slope = max(slope, 0.0)
+            priors[engine] = (max(mean_y - slope * mean_x, 0.0), slope)
+        else:
+            fixed = ENGINE_COST_PRIORS.get(engine, DEFAULT_COST_PRIOR)[0]
+            megapixels, seconds = points[0]
+            priors[engine] = (min(fixed, seconds), max(seconds - fixed, 0.0) / max(megapixels, 1e-6))
+    return priors
+
+
+class ThroughputTracker:
+    """
+    Measured segmentation cost per engine on this host, used to predict latency
+
+    Predictions scale the engine's prior cost curve by the median ratio of
+    recent measured to predicted durations, so a few observations at any
+    image size calibrate the estimate for every size.
+    """
+
+    def __init__(self, priors=None, window=THROUGHPUT_WINDOW):
+        self.priors = dict(ENGINE_COST_PRIORS)
+        if priors:
+            self.priors.update(priors)
+        self.window = window
+        self._observations = {}
+        self._lock = threading.Lock()
+
+    def prior(self, engine):
+        return self.priors.get(engine, DEFAULT_COST_PRIOR)
+
+    def record(self, engine, pixels, seconds):
+        """Record that engine took seconds on an image of this many pixels"""
+        if pixels <= 0:
+            return
+        ratio = seconds / max(_prior_seconds(self.prior(engine), pixels), 1e-6)
+        with self._lock:
+            observations = self._observations.get(engine)
+            if observations is None:
+                observations = self._observations[engine] = deque(maxlen=self.window)
+            observations.append(ratio)
+
+    def predict(self, engine, pixels):
+        """Predicted seconds for engine on an image of this many pixels"""
+        seconds = _prior_seconds(self.prior(engine), pixels)
+        with self._lock:
+            observations = list(self._observations.get(engine, ()))
+        if observations:
+            seconds *= statistics.median(observations)
+        return seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                engine: {'samples': len(observations), 'scale': round(statistics.median(observations), 3)}
+                for engine, observations in self._observations.items() if observations
+            }
+
+
+def _proxy_pixels(size, proxy_edge):
+    width, height = size
+    if not proxy_edge or max(size) <= proxy_edge:
+        return width * height
+    scale = proxy_edge / max(size)
+    return max(1, round(width * scale)) * max(1, round(height * scale))
+
+
+def predict_plan_seconds(tracker, engine, size, proxy_edge):
+    """Predicted segmentation time for engine at proxy_edge on an image of this size"""
+    seconds = tracker.predict(engine, _proxy_pixels(size, proxy_edge))
+    if proxy_edge and max(size) > proxy_edge:
+        seconds += tracker.predict('refine', size[0] * size[1])
+    return seconds
+
+
+def choose_plan(size, ladder, engine_name, tracker, tier=None, max_latency_ms=None):
+    """
+    Pick a rung of ladder for an image of this (width, height)
+
+    engine_name maps a rung's model or engine to its tracker name. Without a
+    budget the tier's first rung is used; with max_latency_ms the first rung
+    at or below the tier predicted to fit, or the fastest rung if none does.
+    Returns a dict with tier, engine, proxy_edge and predicted_ms.
+    """
+    rank = QUALITY_TIERS.index(tier) if tier else 0
+    candidates = [rung for rung in ladder if QUALITY_TIERS.index(rung[0]) >= rank] or list(ladder[-1:])
+
+    chosen = None
+    for rung_tier, engine, proxy_edge in candidates:
+        predicted = predict_plan_seconds(tracker, engine_name(engine), size, proxy_edge) * 1000
+        chosen = {'tier': rung_tier, 'engine': engine, 'proxy_edge': proxy_edge, 'predicted_ms': round(predicted, 1)}
+        if max_latency_ms is None or predicted <= max_latency_ms:
+            break
+    return chosen
@@ -0,0 +1,167 @@
+import os
+import io
+import logging
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# Output formats the API can produce: name -> (PIL format, mimetype, extension)
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'avif': ('AVIF', 'image/avif', 'avif'),
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+# Formats that can carry an animated result
+ANIMATED_FORMATS = ('webp', 'png')
+
+# Encoder defaults; compression is an effort level from 0 (fastest) to 9
+DEFAULT_JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 90))
+DEFAULT_WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', 85))
+DEFAULT_AVIF_QUALITY = int(os.environ.get('AVIF_QUALITY', 70))
+DEFAULT_COMPRESSION = int(os.environ.get('OUTPUT_COMPRESSION', 1))
+
+# Preference order when the client leaves the choice to us
+OPAQUE_PREFERENCE = ('jpeg', 'webp', 'avif', 'png')
+TRANSPARENT_PREFERENCE = ('webp', 'png', 'avif')
+
+
+def _feature_available(name):
+    try:
+        return bool(features.check(name))
+    except ValueError:
+        # Older Pillow builds do not know about the feature at all
+        return False
+
+
+def available_formats():
+    """Output formats this Pillow build can encode"""
+    formats = ['png', 'jpeg']
+    if _feature_available('webp'):
+        formats.append('webp')
+    if _feature_available('avif'):
+        formats.append('avif')
+    return formats
+
+
+def normalize_format(name):
+    """Canonical format name for user input such as 'JPG', or None if unknown"""
+    if not name:
+        return None
+    name = FORMAT_ALIASES.get(name.strip().lower(), name.strip().lower())
+    return name if name in OUTPUT_FORMATS else None
+
+
+def format_mimetype(fmt):
+    return OUTPUT_FORMATS[fmt][1]
+
+
+def format_extension(fmt):
+    return OUTPUT_FORMATS[fmt][2]
+
+
+def _parse_accept(accept_header):
+    """Map each explicitly accepted image mimetype to its q-value"""
+    accepted = {}
+    for part in (accept_header or '').split(','):
+        pieces = [p.strip() for p in part.split(';')]
+        mimetype = pieces[0].lower()
+        if not mimetype.startswith('image/') or mimetype == 'image/*':
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[mimetype] = q
+    return accepted
+
+
+def negotiate_format(accept_header, has_alpha):
+    """
+    Pick an output format from the Accept header and whether the result has alpha
+
+    Formats the client names explicitly win, in our preference order for the
+    kind of result. Otherwise opaque results get JPEG and transparent ones get
+    fast-level PNG, which every client can read.
+    """
+    supported = available_formats()
+    preference = TRANSPARENT_PREFERENCE if has_alpha else OPAQUE_PREFERENCE
+    accepted = _parse_accept(accept_header)
+
+    candidates = [fmt for fmt in preference
+                  if fmt in supported and accepted.get(format_mimetype(fmt), 0) > 0]
+    if candidates:
+        best_q = max(accepted[format_mimetype(fmt)] for fmt in candidates)
+        return next(fmt for fmt in candidates if accepted[format_mimetype(fmt)] == best_q)
+    return 'png' if has_alpha else 'jpeg'
+
+
+def encode_image(image, fmt='png', quality=None, compression=None):
+    """
+    Encode a PIL image in the given output format and return the bytes
+
+    quality applies to lossy formats (1-100). compression is an effort level
+    from 0 (fastest) to 9 (smallest): the PNG compress level, scaled to the
+    WebP method, and inverted into the AVIF speed. WebP is lossless for
+    images with alpha.
+    """
+    image, params = _encoder_params(image, fmt, quality, compression)
+    output = io.BytesIO()
+    image.save(output, OUTPUT_FORMATS[fmt][0], **params)
+    return output.getvalue()
+
+
+def animation_format(fmt):
+    """Output format for an animated result when fmt was requested or negotiated"""
+    if fmt in ANIMATED_FORMATS and fmt in available_formats():
+        return fmt
+    return 'webp' if 'webp' in available_formats() else 'png'
+
+
+def encode_animation(frames, durations, fmt='webp', quality=None, compression=None, loop=0):
+    """
+    Encode equally sized PIL frames as an animated WebP or PNG (APNG)
+
+    durations are per-frame display times in milliseconds; quality and
+    compression are as for encode_image.
+    """
+    first, params = _encoder_params(frames[0], fmt, quality, compression)
+    output = io.BytesIO()
+    first.save(output, OUTPUT_FORMATS[fmt][0], save_all=True, append_images=frames[1:],
+               duration=list(durations), loop=loop, **params)
+    return output.getvalue()
+
+
+def _encoder_params(image, fmt, quality, compression):
+    """Return (image converted for the format, PIL save parameters)"""
+    compression = DEFAULT_COMPRESSION if compression is None else max(0, min(9, int(compression)))
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA')
+    params = {}
+
+    if fmt == 'png':
+        params['compress_level'] = compression
+    elif fmt == 'jpeg':
+        if has_alpha:
+            # JPEG cannot carry alpha, so flatten onto white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        params['quality'] = quality or DEFAULT_JPEG_QUALITY
+    elif fmt == 'webp':
+        params['method'] = round(compression * 6 / 9)
+        if has_alpha:
+            params['lossless'] = True
+        else:
+            params['quality'] = quality or DEFAULT_WEBP_QUALITY
+    elif fmt == 'avif':
+        params['quality'] = quality or DEFAULT_AVIF_QUALITY
+        params['speed'] = 10 - compression
+    return image, params
@@ -0,0 +1,90 @@
+import io
+import os
+import math
+import logging
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# rembg inputs are decoded from JPEGs at a reduced DCT scale whose long edge is
+# still at least this (and at least the model's input size); 0 disables
+SEGMENT_DECODE_EDGE = int(os.environ.get('SEGMENT_DECODE_EDGE', 1024))
+
+EXIF_ORIENTATION = 0x0112
+# Orientations whose display size swaps width and height
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def shrink(image, target):
+    """Resize an opened image to target, reducing JPEGs while decoding"""
+    if image.format == 'JPEG':
+        image.draft(image.mode, target)
+    return image.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+
+def orient(image):
+    """Apply EXIF orientation in place, without copying images that need no rotation"""
+    image.load()
+    if image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+class ImageSource:
+    """
+    Uploaded image bytes, opened once and decoded on demand
+
+    size is the display size (after EXIF orientation and the pixel limit),
+    read from the header. image() decodes at that size once; reduced(edge)
+    decodes a JPEG at the smallest DCT scale (1/2, 1/4 or 1/8) whose long edge
+    is still at least edge, without ever decoding it at full size. Both apply
+    EXIF orientation exactly once. limit_size maps the stored size to the size
+    to decode at, raising if the image is not acceptable.
+    """
+
+    def __init__(self, data, limit_size=None):
+        self.data = data
+        header = self._open()
+        self.format = header.format
+        self.stored_size = header.size
+        self.decoded_size = limit_size(header.size) if limit_size else header.size
+        self.orientation = header.getexif().get(EXIF_ORIENTATION, 1)
+        width, height = self.decoded_size
+        self.size = (height, width) if self.orientation in TRANSPOSING_ORIENTATIONS else (width, height)
+        self._image = None
+
+    def _open(self):
+        return Image.open(io.BytesIO(self.data))
+
+    @property
+    def decoded(self):
+        """Whether the full-size image has been decoded"""
+        return self._image is not None
+
+    def image(self):
+        """The full-size image, decoded on first call"""
+        if self._image is None:
+            image = self._open()
+            if image.size != self.decoded_size:
+                logger.info(f"Downscaled {image.size[0]}x{image.size[1]} image to "
+                            f"{self.decoded_size[0]}x{self.decoded_size[1]} to fit MAX_IMAGE_PIXELS")
+                image = shrink(image, self.decoded_size)
+            self._image = orient(image)
+        return self._image
+
+    def reduced(self, edge):
+        """A decode whose long edge is at least edge, or None when only a full decode would do"""
+        if self._image is not None or self.format != 'JPEG' or not edge:
+            return None
+        width, height = self.decoded_size
+        scale = edge / max(width, height)
+        # DCT scaling reduces by at least half
+        if scale > 0.5:
+            return None
+        image = self._open()
+        image.draft(image.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+        if image.size == self.stored_size:
+            return None
+        logger.info(f"Decoded {width}x{height} JPEG at {image.size[0]}x{image.size[1]} for segmentation")
+        return orient(image)
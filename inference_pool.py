@@ -0,0 +1,162 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment
+INFERENCE_POOL_SIZE = int(os.environ.get('INFERENCE_POOL_SIZE', 0))  # 0 disables the pool
+INFERENCE_THREADS_PER_PROCESS = int(os.environ.get('INFERENCE_THREADS_PER_PROCESS', 0))  # 0 = cores / pool size
+
+# Remover owned by each pool process
+_pool_remover = None
+
+
+def _init_pool_worker(ort_threads):
+    """Create the per-process remover and its model session"""
+    global _pool_remover
+    # rembg applies OMP_NUM_THREADS to the onnxruntime sessions it creates
+    os.environ['OMP_NUM_THREADS'] = str(ort_threads)
+
+    from minimal_rembg_processor import MinimalBackgroundRemover
+    from mask_cache import MaskCache
+    from backends import BACKENDS, WARMUP_BACKENDS
+    if WARMUP_BACKENDS:
+        BACKENDS.warm_up(WARMUP_BACKENDS)
+    # Masks are cached once in the parent, not per process
+    _pool_remover = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0, disk_dir=None))
+    if os.environ.get('WARMUP_ON_START', 'true').lower() in ('1', 'true', 'yes'):
+        _pool_remover.warm_up()
+
+
+def _attach(name):
+    """Attach to a shared memory block owned by the parent process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching always registers the block, but pool
+        # processes share the parent's resource tracker so the parent's
+        # unlink still clears it
+        return shared_memory.SharedMemory(name=name)
+
+
+def _segment_shared(pixels_name, mask_name, shape, model, fallback_engine=None, engine=None):
+    """Segment the RGB pixels in one shared block and write the mask into another"""
+    pixels_shm = _attach(pixels_name)
+    mask_shm = _attach(mask_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=pixels_shm.buf)
+        image = Image.fromarray(pixels, 'RGB')
+        mask, engine = _pool_remover._segment_native(image, model, fallback_engine, engine)
+
+        mask_view = np.ndarray(shape[:2], dtype=np.uint8, buffer=mask_shm.buf)
+        mask_view[:] = np.asarray(mask)
+
+        # Views into the blocks must be gone before they can be closed
+        del pixels, image, mask_view
+        return engine, _pool_remover.fallback_mode
+    finally:
+        for shm in (pixels_shm, mask_shm):
+            try:
+                shm.close()
+            except BufferError:
+                # A failed segmentation can leave views alive in the traceback;
+                # the mapping is released with them and the parent unlinks it
+                pass
+
+
+class InferencePool:
+    """Pool of processes, each with its own remover and model session
+
+    Decoded pixels and computed masks cross the process boundary through
+    multiprocessing.shared_memory; only block names and the shape are pickled.
+    """
+
+    def __init__(self, size=INFERENCE_POOL_SIZE, threads_per_process=INFERENCE_THREADS_PER_PROCESS):
+        self.size = max(1, size)
+        self.threads_per_process = threads_per_process or max(1, (os.cpu_count() or 1) // self.size)
+        self.fallback_mode = False
+        self.fallback_activations = 0
+        self.completed = 0
+        self.failed = 0
+
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Start the worker processes on first use, and again after a fork"""
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.size,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_pool_worker,
+                    initargs=(self.threads_per_process,)
+                )
+                self._executor_pid = os.getpid()
+                logger.info(f"Inference pool started: {self.size} processes, "
+                            f"{self.threads_per_process} onnxruntime threads each")
+            return self._executor
+
+    def segment(self, image, model, fallback_engine=None, engine=None):
+        """Compute the mask for a PIL image in a pool process, returning (mask, engine)"""
+        rgb = image if image.mode == 'RGB' else image.convert('RGB')
+        width, height = rgb.size
+        shape = (height, width, 3)
+
+        pixels_shm = shared_memory.SharedMemory(create=True, size=height * width * 3)
+        mask_shm = shared_memory.SharedMemory(create=True, size=height * width)
+        try:
+            pixels = np.ndarray(shape, dtype=np.uint8, buffer=pixels_shm.buf)
+            pixels[:] = np.asarray(rgb)
+            del pixels
+
+            future = self._get_executor().submit(
+                _segment_shared, pixels_shm.name, mask_shm.name, shape, model, fallback_engine, engine
+            )
+            try:
+                engine, fallback_mode = future.result()
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            with self._lock:
+                self.completed += 1
+                if fallback_mode and not self.fallback_mode:
+                    self.fallback_activations += 1
+                self.fallback_mode = fallback_mode
+
+            mask_view = np.ndarray((height, width), dtype=np.uint8, buffer=mask_shm.buf)
+            mask = Image.fromarray(mask_view.copy(), 'L')
+            del mask_view
+            return mask, engine
+        finally:
+            pixels_shm.close()
+            pixels_shm.unlink()
+            mask_shm.close()
+            mask_shm.unlink()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'threads_per_process': self.threads_per_process,
+                'started': self._executor is not None and self._executor_pid == os.getpid(),
+                'completed': self.completed,
+                'failed': self.failed,
+                'fallback_mode': self.fallback_mode,
+                'fallback_activations': self.fallback_activations,
+            }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=wait)
+            self._executor = None
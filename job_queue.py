@@ -0,0 +1,244 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment
+JOB_WORKER_MODE = os.environ.get('JOB_WORKER_MODE', 'thread')  # 'thread' or 'process'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 50))
+JOB_MAX_RETAINED = int(os.environ.get('JOB_MAX_RETAINED', 100))
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+JOB_RESULT_DIR = os.environ.get('JOB_RESULT_DIR') or None
+
+# Remover owned by each worker process in 'process' mode
+_worker_remover = None
+
+
+def _init_process_worker():
+    """Create the per-process background remover for process-mode workers"""
+    global _worker_remover
+    from minimal_rembg_processor import MinimalBackgroundRemover
+    _worker_remover = MinimalBackgroundRemover()
+    if os.environ.get('WARMUP_ON_START', 'true').lower() in ('1', 'true', 'yes'):
+        _worker_remover.warm_up()
+
+
+def _process_in_worker(input_data, options):
+    """Run one job inside a worker process and return the encoded bytes"""
+    return _worker_remover.remove_background_bytes(input_data, **options)
+
+
+class QueueFullError(Exception):
+    """Raised when too many jobs are already waiting"""
+
+
+class Job:
+    """State of one asynchronous background removal job"""
+
+    def __init__(self, options):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+        self.result_path = None
+        self.result_size = None
+        self.background_type = options.get('background_type')
+        self.model = options.get('model')
+        self.output_format = options.get('output_format', 'png')
+
+    @property
+    def done(self):
+        return self.status in ('finished', 'failed')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'background_type': self.background_type,
+            'model': self.model,
+            'output_format': self.output_format,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result_size': self.result_size,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    """Runs background removal jobs on a local worker pool and retains their results
+
+    In 'thread' mode jobs share the remover returned by remover_factory; in
+    'process' mode every worker process builds its own. Finished jobs are kept
+    until they are older than ttl_seconds or pushed out by max_retained, with
+    result bytes held in memory or written under result_dir.
+    """
+
+    def __init__(self, remover_factory=None, mode=JOB_WORKER_MODE, workers=JOB_WORKERS,
+                 max_pending=JOB_MAX_PENDING, max_retained=JOB_MAX_RETAINED,
+                 ttl_seconds=JOB_TTL_SECONDS, result_dir=JOB_RESULT_DIR):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"Unsupported job worker mode: {mode}")
+
+        self.remover_factory = remover_factory
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_retained = max_retained
+        self.ttl_seconds = ttl_seconds
+        self.result_dir = result_dir
+
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+
+        if self.result_dir:
+            os.makedirs(self.result_dir, exist_ok=True)
+
+        if mode == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_process_worker)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bg-job')
+        logger.info(f"Job manager started with {workers} {mode} workers")
+
+    def submit(self, input_data, options):
+        """Queue a job and return it immediately"""
+        self._purge()
+        job = Job(options)
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if not j.done)
+            if pending >= self.max_pending:
+                raise QueueFullError(f"Too many pending jobs ({pending})")
+            self._jobs[job.id] = job
+            self.submitted += 1
+
+        if self.mode == 'process':
+            future = self._executor.submit(_process_in_worker, input_data, options)
+            # The parent only learns about the job once a worker returns
+            job.status = 'running'
+            job.started_at = time.time()
+            future.add_done_callback(lambda f: self._finish(job, f))
+        else:
+            self._executor.submit(self._run_in_thread, job, input_data, options)
+        return job
+
+    def get(self, job_id):
+        """Return the job, or None if unknown or expired"""
+        self._purge()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_result(self, job_id):
+        """Return the encoded result bytes of a finished job, or None"""
+        job = self.get(job_id)
+        if job is None or job.status != 'finished':
+            return None
+        if job.result_path:
+            try:
+                with open(job.result_path, 'rb') as f:
+                    return f.read()
+            except OSError as e:
+                logger.error(f"Failed to read job result {job.result_path}: {e}")
+                return None
+        return job.result
+
+    def stats(self):
+        """Return queue depth and job counters"""
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+            return {
+                'mode': self.mode,
+                'workers': self.workers,
+                'queued': statuses.count('queued'),
+                'running': statuses.count('running'),
+                'retained': statuses.count('finished') + statuses.count('failed'),
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'expired': self.expired,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run_in_thread(self, job, input_data, options):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            remover = self.remover_factory()
+            result = remover.remove_background_bytes(input_data, **options)
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            self._store(job, None, str(e))
+            return
+        self._store(job, result)
+
+    def _finish(self, job, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            self._store(job, None, str(e))
+            return
+        self._store(job, result)
+
+    def _store(self, job, result, error=None):
+        """Record a job outcome and enforce the retention bound"""
+        if result is None:
+            job.error = error or 'Failed to process image'
+        elif self.result_dir:
+            job.result_path = os.path.join(self.result_dir, f"{job.id}.{job.output_format}")
+            try:
+                with open(job.result_path, 'wb') as f:
+                    f.write(result)
+            except OSError as e:
+                job.result_path = None
+                job.error = f"Failed to store result: {e}"
+        else:
+            job.result = result
+
+        job.result_size = len(result) if result is not None and job.error is None else None
+        job.finished_at = time.time()
+        job.status = 'failed' if job.error else 'finished'
+        logger.info(f"Job {job.id} {job.status} in {job.finished_at - job.created_at:.2f}s")
+
+        with self._lock:
+            if job.error:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self._purge()
+
+    def _purge(self):
+        """Drop expired jobs and the oldest finished ones beyond max_retained"""
+        now = time.time()
+        removed = []
+        with self._lock:
+            finished = [job for job in self._jobs.values() if job.done]
+            overflow = len(finished) - self.max_retained
+            for job in finished:
+                if overflow > 0 or now - job.finished_at > self.ttl_seconds:
+                    overflow -= 1
+                    del self._jobs[job.id]
+                    self.expired += 1
+                    removed.append(job)
+
+        for job in removed:
+            if job.result_path:
+                try:
+                    os.remove(job.result_path)
+                except OSError:
+                    pass
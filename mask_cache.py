@@ -0,0 +1,195 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment
+DEFAULT_MAX_BYTES = int(os.environ.get('MASK_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+DEFAULT_DISK_DIR = os.environ.get('MASK_CACHE_DIR') or None
+DEFAULT_DISK_MAX_BYTES = int(os.environ.get('MASK_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024))
+
+
+class MaskCache:
+    """Content-addressed LRU cache of alpha masks with an optional on-disk tier
+
+    Masks are keyed by a hash of the input bytes plus the engine/model that
+    produced them, so re-compositing the same upload skips segmentation.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, disk_dir=DEFAULT_DISK_DIR,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.disk_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_files())
+            logger.info(f"Mask cache disk tier at {self.disk_dir} ({self.disk_bytes} bytes)")
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    @staticmethod
+    def make_key(input_data, engine):
+        """Build the cache key for an input image and the engine that segments it"""
+        digest = hashlib.sha256(engine.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(input_data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached mask for key as an 'L' image, or None"""
+        with self._lock:
+            mask = self._entries.get(key)
+            if mask is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return mask
+
+        mask = self._read_disk(key)
+        with self._lock:
+            if mask is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store_memory(key, mask)
+        return mask
+
+    def put(self, key, mask):
+        """Store an 'L' mask under key"""
+        if mask.mode != 'L':
+            mask = mask.convert('L')
+        with self._lock:
+            self._store_memory(key, mask)
+        self._write_disk(key, mask)
+
+    def clear(self):
+        """Drop all in-memory entries (the disk tier is left alone)"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current sizes"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'disk_dir': self.disk_dir,
+                'disk_bytes': self.disk_bytes,
+                'disk_max_bytes': self.disk_max_bytes if self.disk_dir else 0,
+                'disk_evictions': self.disk_evictions,
+            }
+
+    def _store_memory(self, key, mask):
+        """Insert into the LRU and evict until under budget (lock must be held)"""
+        size = mask.width * mask.height
+        if size > self.max_bytes:
+            return
+
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.current_bytes -= previous.width * previous.height
+
+        self._entries[key] = mask
+        self.current_bytes += size
+
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.width * evicted.height
+            self.evictions += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.png")
+
+    def _disk_files(self):
+        """Yield (path, size, mtime) for every mask file in the disk tier"""
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith('.png'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with Image.open(path) as mask:
+                mask.load()
+                return mask.convert('L')
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Failed to read cached mask {path}: {e}")
+            return None
+
+    def _write_disk(self, key, mask):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            mask.save(tmp_path, 'PNG', compress_level=1)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to write cached mask {path}: {e}")
+            return
+
+        with self._lock:
+            self.disk_bytes += size
+            over_budget = self.disk_bytes > self.disk_max_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Remove the oldest mask files until the disk tier is under budget"""
+        files = sorted(self._disk_files(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.disk_evictions += 1
+        with self._lock:
+            self.disk_bytes = total
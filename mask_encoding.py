@@ -0,0 +1,90 @@
+import io
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+from image_encoding import DEFAULT_COMPRESSION
+
+# Mask values at or above this count as foreground in 1-bit and RLE output
+MASK_THRESHOLD = 128
+
+
+def _binary(mask, threshold):
+    """Mode '1' copy of an 'L' mask, set where it is at least threshold"""
+    return mask.point(lambda value: 255 if value >= threshold else 0, '1')
+
+
+def encode_mask_png(mask, bits=8, compression=None, threshold=MASK_THRESHOLD):
+    """Encode an 'L' mask as an 8-bit grayscale or 1-bit PNG"""
+    compression = DEFAULT_COMPRESSION if compression is None else max(0, min(9, int(compression)))
+    if bits == 1:
+        mask = _binary(mask, threshold)
+    elif mask.mode != 'L':
+        mask = mask.convert('L')
+    output = io.BytesIO()
+    mask.save(output, 'PNG', compress_level=compression)
+    return output.getvalue()
+
+
+def mask_to_rle(mask, threshold=MASK_THRESHOLD):
+    """
+    Run-length encode a mask within its bounding box
+
+    Returns {'size': [width, height], 'bbox': [x, y, width, height] or None,
+    'counts': [...]}. counts are alternating background and foreground run
+    lengths over the bounding box in row-major order, starting with
+    background (so the first run may be 0).
+    """
+    binary = _binary(mask, threshold)
+    bbox = binary.getbbox()
+    rle = {'size': list(mask.size), 'bbox': None, 'counts': []}
+    if bbox is None:
+        return rle
+
+    left, top, right, bottom = bbox
+    rle['bbox'] = [left, top, right - left, bottom - top]
+    region = binary.crop(bbox)
+    if NUMPY_AVAILABLE:
+        pixels = np.asarray(region, dtype=bool).ravel()
+        # Indices where the value changes, plus both ends, give the run lengths
+        changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+        bounds = np.concatenate(([0], changes, [pixels.size]))
+        counts = np.diff(bounds).tolist()
+        if pixels[0]:
+            counts.insert(0, 0)
+    else:
+        counts = []
+        current, run = False, 0
+        for value in region.convert('L').tobytes():
+            value = bool(value)
+            if value != current:
+                counts.append(run)
+                current, run = value, 0
+            run += 1
+        counts.append(run)
+    rle['counts'] = counts
+    return rle
+
+
+def rle_to_mask(rle):
+    """Decode mask_to_rle output back into a binary 'L' mask (0 or 255)"""
+    width, height = rle['size']
+    mask = Image.new('L', (width, height), 0)
+    if not rle['bbox']:
+        return mask
+
+    x, y, box_width, box_height = rle['bbox']
+    values = bytearray()
+    for index, run in enumerate(rle['counts']):
+        values.extend((255 if index % 2 else 0,) * run)
+    mask.paste(Image.frombytes('L', (box_width, box_height), bytes(values)), (x, y))
+    return mask
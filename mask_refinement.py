@@ -0,0 +1,68 @@
+import os
+import logging
+
+import numpy as np
+from PIL import Image
+
+from backends import BACKENDS
+
+logger = logging.getLogger(__name__)
+
+# Guided filter settings; a radius of 0 scales it with the upsampling factor
+REFINE_RADIUS = int(os.environ.get('REFINE_RADIUS', 0))
+REFINE_EPS = float(os.environ.get('REFINE_EPS', 1e-4))
+
+
+def box_filter(array, radius):
+    """Mean over a (2r+1)x(2r+1) window, in time independent of the radius"""
+    # Prefer the fastest box filter available; all of them are linear time
+    cv2 = BACKENDS.optional('cv2')
+    if cv2 is not None:
+        return cv2.boxFilter(array, -1, (2 * radius + 1, 2 * radius + 1),
+                             borderType=cv2.BORDER_REFLECT)
+    ndimage = BACKENDS.optional('scipy')
+    if ndimage is not None:
+        return ndimage.uniform_filter(array, size=2 * radius + 1, mode='reflect')
+
+    # Separable running sums; float64 keeps the cumulative sums exact enough
+    size = 2 * radius + 1
+    padded = np.pad(array.astype(np.float64), radius, mode='symmetric')
+    summed = np.cumsum(padded, axis=0)
+    summed = np.concatenate([summed[size - 1:size], summed[size:] - summed[:-size]], axis=0)
+    summed = np.cumsum(summed, axis=1)
+    summed = np.concatenate([summed[:, size - 1:size], summed[:, size:] - summed[:, :-size]], axis=1)
+    return (summed / (size * size)).astype(array.dtype)
+
+
+def guided_filter(guide, src, radius, eps):
+    """Edge-preserving smoothing of src steered by guide (He et al.), both float32 in [0, 1]"""
+    mean_i = box_filter(guide, radius)
+    mean_p = box_filter(src, radius)
+    cov_ip = box_filter(guide * src, radius) - mean_i * mean_p
+    var_i = box_filter(guide * guide, radius) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    del cov_ip, var_i, mean_i, mean_p
+
+    return box_filter(a, radius) * guide + box_filter(b, radius)
+
+
+def refine_mask(image, mask, scale=1.0, radius=REFINE_RADIUS, eps=REFINE_EPS):
+    """Upsample a coarse mask to the image size and snap its edges to the full-resolution image
+
+    scale is the factor the mask was computed below full resolution, used to
+    pick the filter radius when none is configured.
+    """
+    if mask.size != image.size:
+        mask = mask.resize(image.size, Image.Resampling.BILINEAR)
+
+    radius = radius or max(2, int(round(2 * scale)))
+    guide = np.asarray(image.convert('L'), dtype=np.float32) / 255.0
+    src = np.asarray(mask, dtype=np.float32) / 255.0
+
+    refined = guided_filter(guide, src, radius, eps)
+    np.clip(refined, 0.0, 1.0, out=refined)
+    refined *= 255.0
+    logger.info(f"Refined mask at {image.size[0]}x{image.size[1]} with guided filter (r={radius})")
+    return Image.fromarray(refined.astype(np.uint8), 'L')
@@ -0,0 +1,105 @@
+import os
+import logging
+
+from backends import BACKENDS
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment (0 threads = onnxruntime's
+# default, or OMP_NUM_THREADS when that is set)
+DEFAULT_ORT_OPTIONS = {
+    'intra_op_threads': int(os.environ.get('ORT_INTRA_OP_THREADS', 0)),
+    'inter_op_threads': int(os.environ.get('ORT_INTER_OP_THREADS', 0)),
+    'graph_optimization': os.environ.get('ORT_GRAPH_OPTIMIZATION', 'all').lower(),
+    'execution_mode': os.environ.get('ORT_EXECUTION_MODE', 'sequential').lower(),
+    'cpu_mem_arena': os.environ.get('ORT_CPU_MEM_ARENA', 'true').lower() in ('1', 'true', 'yes'),
+    'mem_pattern': os.environ.get('ORT_MEM_PATTERN', 'true').lower() in ('1', 'true', 'yes'),
+    # Comma-separated execution providers; empty lets rembg pick (GPU when present)
+    'providers': [p for p in os.environ.get('ORT_PROVIDERS', '').split(',') if p],
+}
+
+# Directory of pre-converted models, loaded instead of downloading (unset disables)
+LOCAL_MODEL_DIR = os.environ.get('LOCAL_MODEL_DIR') or None
+
+# Model file variants to look for in LOCAL_MODEL_DIR, in order of preference:
+# <model>.<variant>.onnx, with 'fp32' meaning the plain <model>.onnx
+MODEL_VARIANTS = tuple(v for v in os.environ.get('MODEL_VARIANTS', 'int8,opt,fp32').split(',') if v)
+
+GRAPH_OPTIMIZATION_LEVELS = ('disable', 'basic', 'extended', 'all')
+EXECUTION_MODES = ('sequential', 'parallel')
+
+
+def resolve_options(overrides=None):
+    """DEFAULT_ORT_OPTIONS with overrides applied; raises ValueError on unknown names or values"""
+    options = dict(DEFAULT_ORT_OPTIONS)
+    for name, value in (overrides or {}).items():
+        if name not in options:
+            raise ValueError(f"Unknown onnxruntime option: {name}")
+        options[name] = value
+    if options['graph_optimization'] not in GRAPH_OPTIMIZATION_LEVELS:
+        raise ValueError(f"graph_optimization must be one of {', '.join(GRAPH_OPTIMIZATION_LEVELS)}")
+    if options['execution_mode'] not in EXECUTION_MODES:
+        raise ValueError(f"execution_mode must be one of {', '.join(EXECUTION_MODES)}")
+    return options
+
+
+def session_options(options):
+    """Build ort.SessionOptions from resolved options, or None without onnxruntime"""
+    ort = BACKENDS.optional('onnxruntime')
+    if ort is None:
+        return None
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = int(options['intra_op_threads'])
+    sess_opts.inter_op_num_threads = int(options['inter_op_threads'])
+    # Same as rembg.new_session, so sessions built here honour OMP_NUM_THREADS too
+    if 'OMP_NUM_THREADS' in os.environ:
+        threads = int(os.environ['OMP_NUM_THREADS'])
+        sess_opts.intra_op_num_threads = sess_opts.intra_op_num_threads or threads
+        sess_opts.inter_op_num_threads = sess_opts.inter_op_num_threads or threads
+    sess_opts.graph_optimization_level = {
+        'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[options['graph_optimization']]
+    sess_opts.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if options['execution_mode'] == 'parallel'
+                                else ort.ExecutionMode.ORT_SEQUENTIAL)
+    sess_opts.enable_cpu_mem_arena = bool(options['cpu_mem_arena'])
+    sess_opts.enable_mem_pattern = bool(options['mem_pattern'])
+    return sess_opts
+
+
+def variant_filename(model, variant):
+    return f"{model}.onnx" if variant == 'fp32' else f"{model}.{variant}.onnx"
+
+
+def find_local_model(model_dir, model, variants=MODEL_VARIANTS):
+    """Return (path, variant) of the first variant of a model present in model_dir, or None"""
+    if not model_dir:
+        return None
+    for variant in variants:
+        path = os.path.join(model_dir, variant_filename(model, variant))
+        if os.path.isfile(path):
+            return path, variant
+    return None
+
+
+def local_session_class(session_class, path):
+    """Subclass of a rembg session class that loads its model from path instead of downloading it"""
+    return type(f"Local{session_class.__name__}", (session_class,),
+                {'download_models': classmethod(lambda cls, *args, **kwargs: path)})
+
+
+def quantize_model(source, destination):
+    """Write a dynamically INT8-quantized copy of an ONNX model (weights only, no calibration data)"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(source, destination, weight_type=QuantType.QUInt8)
+    return destination
+
+
+def optimize_model(source, destination, level='all'):
+    """Write the graph onnxruntime produces at an optimization level, so it need not be redone at load"""
+    sess_opts = session_options(resolve_options({'graph_optimization': level}))
+    sess_opts.optimized_model_filepath = destination
+    BACKENDS.load('onnxruntime').InferenceSession(source, sess_options=sess_opts, providers=['CPUExecutionProvider'])
+    return destination
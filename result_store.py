@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Defaults can be overridden from the environment
+DEFAULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR') or None  # unset disables the store
+DEFAULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+RESULT_CACHE_MAX_AGE = int(os.environ.get('RESULT_CACHE_MAX_AGE', 365 * 24 * 3600))
+
+# Bump when processing changes in a way that should not reuse stored results
+RESULT_FORMAT_VERSION = '1'
+
+_RESULT_NAME = re.compile(r'^([0-9a-f]{64})\.([a-z0-9]+)$')
+
+
+class ResultStore:
+    """Content-addressed store of encoded results on local disk
+
+    Results are keyed by a hash of the input bytes, the processing options and
+    the engine version, and kept as <dir>/<key[:2]>/<key>.<ext>. A key always
+    names the same bytes, so it doubles as a strong ETag and the files can be
+    served as immutable by a CDN or straight from disk by nginx.
+    """
+
+    def __init__(self, directory=DEFAULT_STORE_DIR, max_bytes=DEFAULT_STORE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self.current_bytes = sum(size for _, size, _ in self._files())
+            logger.info(f"Result store at {self.directory} ({self.current_bytes} bytes)")
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    @staticmethod
+    def make_key(input_data, options, engine_version):
+        """Build the key for an input image processed with options by an engine version"""
+        params = {}
+        for name, value in options.items():
+            if name == 'report':
+                continue
+            if isinstance(value, (bytes, bytearray)):
+                value = hashlib.sha256(value).hexdigest()
+            params[name] = value
+        digest = hashlib.sha256(f"{RESULT_FORMAT_VERSION}\0{engine_version}\0".encode('utf-8'))
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(input_data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def relative_path(key, extension):
+        """Path of a result below the store directory, also used in its URL"""
+        return f"{key[:2]}/{key}.{extension}"
+
+    @staticmethod
+    def parse_name(name):
+        """Split a result file name into (key, extension), or None if it is not one"""
+        match = _RESULT_NAME.match(name)
+        return (match.group(1), match.group(2)) if match else None
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f"{key}.{extension}")
+
+    def get(self, key, extension):
+        """Return the file path of a stored result, or None"""
+        if not self.enabled:
+            return None
+        path = self.path(key, extension)
+        try:
+            # Refresh the mtime so eviction drops the least recently used results
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key, extension, data):
+        """Store encoded result bytes under key; returns the file path, or None on failure"""
+        if not self.enabled:
+            return None
+        path = self.path(key, extension)
+        if os.path.exists(path):
+            return path
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Failed to store result {path}: {e}")
+            return None
+
+        with self._lock:
+            self.writes += 1
+            self.current_bytes += len(data)
+            over_budget = self.max_bytes and self.current_bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+    def _files(self):
+        """Yield (path, size, mtime) for every result file in the store"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if self.parse_name(name) is None:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """Remove the least recently used results until the store is under budget"""
+        files = sorted(self._files(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+        with self._lock:
+            self.current_bytes = total
@@ -0,0 +1,83 @@
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Set to false to let identical concurrent requests each compute their own mask
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+
+class _Call:
+    """One computation in flight and the requests waiting on it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one computation
+
+    The first caller for a key runs the function; callers arriving while it
+    runs block until it finishes and get the same result, or the same
+    exception. Nothing is kept once the call completes, so a later call with
+    the key computes again (the mask cache covers reuse over time).
+    """
+
+    def __init__(self, enabled=SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls = {}
+
+        self.executed = 0
+        self.coalesced = 0
+        self.shared_errors = 0
+
+    def do(self, key, fn):
+        """Return (fn() or the in-flight call's result, whether it was shared)"""
+        if not self.enabled or key is None:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+        if not leader:
+            logger.info("Waiting for an identical request already being segmented")
+            call.done.wait()
+            if call.error is not None:
+                with self._lock:
+                    self.shared_errors += 1
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self._calls),
+                'waiting': sum(call.waiters for call in self._calls.values()),
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'shared_errors': self.shared_errors,
+            }
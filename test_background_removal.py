@@ -5,23 +5,62 @@ Test script to verify background removal functionality
 
 import tempfile
 import os
+import io
+import time
+import threading
+import asyncio
 from PIL import Image, ImageDraw
 from minimal_rembg_processor import MinimalBackgroundRemover
+from mask_cache import MaskCache
+from job_queue import JobManager, QueueFullError
+from result_store import ResultStore
+from admission import AdmissionController, AdmissionRejected, request_cost
+from mask_encoding import encode_mask_png, mask_to_rle, rle_to_mask
+from engine_registry import Engine, EngineRegistry, CircuitBreaker, EngineUnavailable
+from image_loading import ImageSource
+from background_library import BackgroundLibrary, LibraryFullError
+
+def create_test_subject(size=300, background='white'):
+    """
+    Draw the test subject at any size and return (image, ground-truth mask)
+    
+    background is a color or an RGB image of the same size to draw over.
+    """
+    if isinstance(background, Image.Image):
+        img = background.copy()
+    else:
+        img = Image.new('RGB', (size, size), background)
+    mask = Image.new('L', (size, size), 0)
+    
+    # A red circle in the center (this should be preserved)
+    scale = size / 300
+    box = [round(100 * scale), round(100 * scale), round(200 * scale), round(200 * scale)]
+    ImageDraw.Draw(img).ellipse(box, fill='red', outline='darkred', width=max(1, round(3 * scale)))
+    ImageDraw.Draw(mask).ellipse(box, fill=255)
+    return img, mask
 
 def create_test_image():
     """Create a simple test image with a clear subject and background"""
-    # Create a 300x300 image with white background
-    img = Image.new('RGB', (300, 300), 'white')
-    draw = ImageDraw.Draw(img)
-    
-    # Draw a red circle in the center (this should be preserved)
-    draw.ellipse([100, 100, 200, 200], fill='red', outline='darkred', width=3)
+    # A 300x300 image with white background
+    img, _ = create_test_subject(300)
     
     # Save to temporary file
     temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
     img.save(temp_file.name, 'PNG')
     return temp_file.name
 
+def png_bytes(size=80):
+    """The test subject encoded as PNG upload bytes"""
+    buffer = io.BytesIO()
+    create_test_subject(size)[0].save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def load_app():
+    """Import the Flask app module without warming up rembg models"""
+    os.environ.setdefault('WARMUP_ON_START', 'false')
+    import app
+    return app
+
 def test_background_removal():
     """Test the background removal functionality"""
     print("🧪 Testing Background Removal Functionality...")
@@ -45,35 +84,20 @@ def test_background_removal():
         
         # Test background removal
         print(f"📸 Processing test image with {mode}...")
-        success = processor.remove_background(input_path, output_path, 'transparent')
-        
-        if success:
-            # Check if output file exists and has content
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                print("✅ Background removal completed successfully!")
-                print(f"📁 Output saved to: {output_path}")
-                
-                # Load and check the result
-                result_img = Image.open(output_path)
-                print(f"📊 Result image size: {result_img.size}")
-                print(f"📊 Result image mode: {result_img.mode}")
-                
-                if result_img.mode == 'RGBA':
-                    print("✅ Image has transparency channel - background removal working!")
-                else:
-                    print("⚠️  Image doesn't have transparency - check processing")
-                
-                return True
-            else:
-                print("❌ Output file was not created properly")
-                return False
-        else:
-            print("❌ Background removal failed")
-            return False
-            
-    except Exception as e:
-        print(f"❌ Test failed with error: {e}")
-        return False
+        assert processor.remove_background(input_path, output_path, 'transparent'), "Background removal failed"
+        
+        # Check if output file exists and has content
+        assert os.path.exists(output_path) and os.path.getsize(output_path) > 0, \
+            "Output file was not created properly"
+        print("✅ Background removal completed successfully!")
+        print(f"📁 Output saved to: {output_path}")
+        
+        # Load and check the result
+        result_img = Image.open(output_path)
+        print(f"📊 Result image size: {result_img.size}")
+        print(f"📊 Result image mode: {result_img.mode}")
+        assert result_img.mode == 'RGBA', "Image doesn't have a transparency channel"
+        print("✅ Image has transparency channel - background removal working!")
     finally:
         # Clean up temporary files
         try:
@@ -83,11 +107,901 @@ def test_background_removal():
         except:
             pass
 
+def test_background_removal_bytes():
+    """Test the in-memory bytes API with a solid background"""
+    input_path = create_test_image()
+    try:
+        with open(input_path, 'rb') as f:
+            input_data = f.read()
+        
+        processor = MinimalBackgroundRemover()
+        # Exercise the local fallback engines so the test runs offline
+        processor.rembg = False
+        
+        result_data = processor.remove_background_bytes(
+            input_data, background_type='solid', background_color='#00FF00'
+        )
+        assert result_data is not None
+        
+        result_img = Image.open(io.BytesIO(result_data))
+        assert result_img.format == 'PNG'
+        assert result_img.size == (300, 300)
+        assert result_img.mode == 'RGB'
+    finally:
+        os.unlink(input_path)
+
+def test_mask_cache_skips_segmentation():
+    """Re-compositing the same upload should reuse the cached mask"""
+    input_path = create_test_image()
+    try:
+        with open(input_path, 'rb') as f:
+            input_data = f.read()
+        
+        processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=1024 * 1024))
+        processor.rembg = False
+        
+        assert processor.remove_background_bytes(input_data) is not None
+        assert processor.remove_background_bytes(
+            input_data, background_type='solid', background_color='#0000FF'
+        ) is not None
+        
+        stats = processor.mask_cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+        assert stats['bytes'] == 300 * 300
+    finally:
+        os.unlink(input_path)
+
+def wait_for_job(manager, job_id, timeout=10):
+    """Poll a job until it is done, returning it"""
+    deadline = time.time() + timeout
+    job = manager.get(job_id)
+    while not job.done and time.time() < deadline:
+        time.sleep(0.01)
+        job = manager.get(job_id)
+    return job
+
+def test_job_submit_poll_and_result():
+    """A submitted job should run in the background and expose its encoded result"""
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = False
+    manager = JobManager(lambda: processor, workers=1, result_dir=tempfile.mkdtemp())
+    with open(create_test_image(), 'rb') as f:
+        upload = f.read()
+    try:
+        job = manager.submit(upload, {})
+        assert job.status in ('queued', 'running', 'finished')
+        job = wait_for_job(manager, job.id)
+        assert job.status == 'finished' and job.error is None
+        result = manager.get_result(job.id)
+        assert len(result) == job.result_size and Image.open(io.BytesIO(result)).mode == 'RGBA'
+        assert manager.stats()['completed'] == 1
+        assert manager.get_result('unknown') is None
+    finally:
+        manager.shutdown()
+
+def test_job_queue_rejects_when_full_and_expires_finished_jobs():
+    """Submissions beyond max_pending should be refused, and finished jobs dropped after their TTL"""
+    release = threading.Event()
+    
+    class BlockingRemover:
+        def remove_background_bytes(self, input_data, **options):
+            release.wait(5)
+            return b'result'
+    
+    result_dir = tempfile.mkdtemp()
+    manager = JobManager(BlockingRemover, workers=1, max_pending=2, ttl_seconds=0.2, result_dir=result_dir)
+    try:
+        jobs = [manager.submit(b'input', {}) for _ in range(2)]
+        try:
+            manager.submit(b'input', {})
+            assert False, 'expected QueueFullError'
+        except QueueFullError:
+            pass
+        
+        release.set()
+        jobs = [wait_for_job(manager, job.id) for job in jobs]
+        assert all(job.status == 'finished' for job in jobs)
+        assert manager.get_result(jobs[0].id) == b'result' and len(os.listdir(result_dir)) == 2
+        
+        time.sleep(0.3)
+        assert manager.get(jobs[0].id) is None and manager.get_result(jobs[1].id) is None
+        assert manager.stats()['expired'] == 2 and os.listdir(result_dir) == []
+    finally:
+        manager.shutdown()
+
+def test_proxy_segmentation_keeps_full_resolution():
+    """Segmenting on a proxy should still return a full-size mask"""
+    input_path = create_test_image()
+    try:
+        with open(input_path, 'rb') as f:
+            input_data = f.read()
+        
+        processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+        processor.rembg = False
+        
+        mask, engine = processor._segment(processor._decode_image(input_data), 'u2net', proxy_edge=128)
+        assert engine == 'fallback@128'
+        assert mask.size == (300, 300)
+        assert mask.getpixel((150, 150)) > 127
+        assert mask.getpixel((5, 5)) < 128
+    finally:
+        os.unlink(input_path)
+
+def test_stored_results_are_immutable_and_conditional():
+    """Stored results should carry a strong ETag, answer 304 and 206, and be cacheable forever"""
+    app_module = load_app()
+    store = app_module.result_store
+    app_module.result_store = ResultStore(tempfile.mkdtemp())
+    remover = app_module.get_bg_remover()
+    rembg = remover.rembg
+    remover.rembg = False
+    try:
+        client = app_module.app.test_client()
+        response = client.post('/remove-background', data={
+            'image': (io.BytesIO(png_bytes()), 'subject.png'),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200
+        location = response.headers['Content-Location']
+        etag = response.headers['ETag']
+        assert location.startswith('/results/') and not etag.startswith('W/')
+        
+        stored = client.get(location)
+        assert stored.status_code == 200 and stored.data == response.data
+        assert stored.headers['ETag'] == etag
+        cache_control = stored.headers['Cache-Control']
+        assert 'immutable' in cache_control and 'public' in cache_control
+        assert f"max-age={app_module.RESULT_CACHE_MAX_AGE}" in cache_control
+        
+        assert client.get(location, headers={'If-None-Match': etag}).status_code == 304
+        partial = client.get(location, headers={'Range': 'bytes=0-9'})
+        assert partial.status_code == 206 and partial.data == response.data[:10]
+        assert partial.headers['Content-Range'] == f"bytes 0-9/{len(response.data)}"
+        
+        # The same upload and options are served from the store
+        again = client.post('/remove-background', data={
+            'image': (io.BytesIO(png_bytes()), 'subject.png'),
+        }, content_type='multipart/form-data')
+        assert again.headers['X-Segmentation-Engine'] == 'store' and again.data == response.data
+        for header in ('Content-Type', 'Cache-Control', 'Vary'):
+            assert again.headers.get(header) == response.headers.get(header)
+        assert again.headers['Content-Disposition'].startswith('attachment; filename=processed_')
+        assert client.get('/results/00/' + '0' * 64 + '.png').status_code == 404
+    finally:
+        app_module.result_store = store
+        remover.rembg = rembg
+
+def test_fallback_result_is_not_stored_under_rembg_key():
+    """A result made by a fallback engine after rembg failed should not be stored as rembg's"""
+    app_module = load_app()
+    store = app_module.result_store
+    app_module.result_store = ResultStore(tempfile.mkdtemp())
+    remover = app_module.get_bg_remover()
+    rembg = remover.rembg
+    # rembg looks usable when the key is made, but this request is segmented by a fallback
+    remover.rembg = False
+    remover._rembg_usable = lambda model=None: True
+    remover.engine_version = lambda: 'rembg-test'
+    try:
+        client = app_module.app.test_client()
+        post = lambda: client.post('/remove-background', data={
+            'image': (io.BytesIO(png_bytes(64)), 'subject.png'),
+        }, content_type='multipart/form-data')
+        response = post()
+        assert response.status_code == 200
+        assert response.headers['X-Segmentation-Engine'].startswith('fallback')
+        assert 'Content-Location' not in response.headers
+        assert post().headers['X-Segmentation-Engine'] != 'store'
+        assert app_module.result_store.stats()['bytes'] == 0
+    finally:
+        app_module.result_store = store
+        remover.rembg = rembg
+        del remover._rembg_usable, remover.engine_version
+
+def test_animation_reuses_masks_of_similar_frames():
+    """Frames close to the last keyframe should keep its mask instead of being segmented"""
+    frames = []
+    for shift in range(6):
+        frame, _ = create_test_subject(120)
+        frames.append(frame.transform(frame.size, Image.AFFINE, (1, 0, -(shift % 2), 0, 1, 0), fillcolor='white'))
+    buffer = io.BytesIO()
+    frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=50, loop=0)
+    
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = False
+    
+    report = {}
+    result = processor.remove_background_animation(buffer.getvalue(), 'png', report=report)
+    assert report['frames'] == 6
+    assert report['keyframes'] == 1
+    with Image.open(io.BytesIO(result)) as animation:
+        assert animation.n_frames == 6
+        assert animation.mode == 'RGBA'
+    
+def test_mask_output_round_trips_through_rle():
+    """The RLE mask output should decode back to the 1-bit mask"""
+    _, truth = create_test_subject(90)
+    rle = mask_to_rle(truth)
+    assert rle['bbox'] == [30, 30, 31, 31]
+    assert sum(rle['counts']) == 31 * 31
+    assert rle_to_mask(rle).tobytes() == truth.point(lambda v: 255 if v >= 128 else 0).tobytes()
+    
+    with Image.open(io.BytesIO(encode_mask_png(truth, bits=1))) as bilevel:
+        assert bilevel.mode == '1'
+
+def test_admission_rejects_with_retry_after_and_releases_pixels():
+    """A full pixel budget should turn requests away with 429 and free pixels once requests finish"""
+    app_module = load_app()
+    controller = app_module.admission
+    admission = app_module.admission = AdmissionController(
+        max_concurrent=1, max_inflight_pixels=0, max_queued_pixels=10_000, queue_timeout=0.1)
+    remover = app_module.get_bg_remover()
+    rembg = remover.rembg
+    remover.rembg = False
+    upload = png_bytes()
+    cost = request_cost(upload)
+    try:
+        client = app_module.app.test_client()
+        post = lambda: client.post('/remove-background', data={
+            'image': (io.BytesIO(upload), 'subject.png'),
+        }, content_type='multipart/form-data')
+        
+        # A request holding the only slot makes the next one wait, then give up
+        admission.acquire(cost)
+        response = post()
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+        assert response.json['retry_after'] == int(response.headers['Retry-After'])
+        assert admission.stats()['timed_out'] == 1 and admission.queued_pixels == 0
+        
+        # With one request already queued, another that would overflow the queue is rejected at once
+        def queued_request():
+            admission.acquire(cost)
+            admission.release(cost, 0.01)
+        
+        waiter = threading.Thread(target=queued_request)
+        waiter.start()
+        while admission.stats()['queued'] < 1:
+            time.sleep(0.01)
+        try:
+            admission.acquire(cost)
+            assert False, 'expected AdmissionRejected'
+        except AdmissionRejected as e:
+            assert e.retry_after >= 1
+        admission.release(cost, 0.05)
+        waiter.join(5)
+        
+        assert post().status_code == 200
+        stats = admission.stats()
+        assert stats['running'] == 0 and stats['inflight_pixels'] == 0 and stats['queued_pixels'] == 0
+        assert stats['rejected'] == 1 and stats['drain_pixels_per_second'] > 0
+    finally:
+        app_module.admission = controller
+        remover.rembg = rembg
+
+def test_engine_breaker_recovers_after_transient_errors():
+    """Failing rembg calls should open its breaker instead of disabling it for good"""
+    registry = EngineRegistry(lambda: CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=0.05))
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0), engines=registry)
+    calls = []
+    
+    def flaky(image):
+        calls.append(image.size)
+        if len(calls) <= 2:
+            raise RuntimeError('transient inference error')
+        return Image.new('L', image.size, 255)
+    
+    registry.register(Engine('rembg:u2net', flaky, kind='rembg'))
+    image, _ = create_test_subject(60)
+    assert [processor._segment(image, 'u2net')[1] for _ in range(3)] == ['fallback'] * 3
+    assert len(calls) == 2
+    assert processor.fallback_mode and processor.fallback_activations == 1
+    
+    # After the cooldown one trial call goes through and closes the breaker
+    time.sleep(0.06)
+    assert processor._segment(image, 'u2net')[1] == 'rembg:u2net'
+    assert registry.breakers['rembg:u2net'].state == 'closed'
+    
+    # A forced engine is used even though rembg is healthy
+    assert processor._segment(image, 'u2net', engine='fallback:advanced_pil')[1] == 'fallback:advanced_pil'
+
+def test_reduced_jpeg_decode_for_segmentation():
+    """Rotated JPEGs should segment from a reduced decode and return a mask at display size"""
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    Image.new('RGB', (2400, 1600), 'white').save(buffer, 'JPEG', exif=exif)
+    data = buffer.getvalue()
+    
+    source = ImageSource(data)
+    assert source.size == (1600, 2400)
+    assert source.reduced(1024).size == (800, 1200) and not source.decoded
+    
+    registry = EngineRegistry()
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0), engines=registry)
+    registry.register(Engine('rembg:u2net', lambda image: Image.new('L', image.size, 255), kind='rembg'))
+    seen = []
+    segment_native = processor._segment_native
+    processor._segment_native = lambda image, *args, **kwargs: seen.append(image.size) or segment_native(image, *args, **kwargs)
+    image, mask = processor.process_mask(data, model='u2net', engine='rembg:u2net', need_image=False)
+    assert image is None and mask.size == (1600, 2400)
+    assert seen == [(800, 1200)]
+
+def test_identical_concurrent_requests_share_one_mask():
+    """Duplicates arriving while a mask is computed should wait for it instead of segmenting"""
+    registry = EngineRegistry()
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0), engines=registry)
+    started, release, calls = threading.Event(), threading.Event(), []
+    
+    def slow(image):
+        calls.append(image.size)
+        started.set()
+        release.wait(5)
+        return Image.new('L', image.size, 255)
+    
+    registry.register(Engine('rembg:u2net', slow, kind='rembg'))
+    image, _ = create_test_subject(80)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    input_data = buffer.getvalue()
+    reports = [{} for _ in range(3)]
+    threads = [threading.Thread(target=processor.process_image, args=(input_data,),
+                                kwargs={'model': 'u2net', 'report': report}) for report in reports]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while processor.single_flight.stats()['waiting'] < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    
+    assert len(calls) == 1
+    assert sorted(report['coalesced'] for report in reports) == [False, True, True]
+    assert processor.single_flight.stats()['coalesced'] == 2
+
+def test_batch_records_inference_duration():
+    """A batched rembg run should record its own duration against the engine's breaker"""
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = True
+    processor._batch_predict = lambda images, model: [Image.new('L', image.size, 255) for image in images]
+    inputs = []
+    for size in (60, 80, 100):
+        buffer = io.BytesIO()
+        create_test_subject(size)[0].save(buffer, 'PNG')
+        inputs.append(buffer.getvalue())
+    
+    report = {}
+    results = processor.process_batch(inputs, model='u2net', report=report)
+    assert all(result is not None for result in results) and report['engine'] == 'rembg:u2net'
+    stats = processor.engines.breakers['rembg:u2net'].stats()
+    assert stats['successes'] == 1
+    assert stats['mean_ms'] < 5000
+
+def test_failed_warm_up_is_recorded():
+    """A model that cannot load should be reported as failed rather than left pending"""
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    
+    def unavailable(model):
+        raise ConnectionError('model download failed')
+    
+    processor._get_session = unavailable
+    assert processor.warm_up('u2net') is False
+    assert 'u2net' not in processor.warmed_models
+    assert 'download failed' in processor.warmup_failures['u2net']
+    assert processor.engines.breakers['rembg:u2net'].state == 'open'
+    assert processor._segment(create_test_subject(60)[0], 'u2net')[1] == 'fallback'
+
+def test_forced_engine_that_cannot_load_is_reported():
+    """A forced rembg model that fails to load should raise EngineUnavailable, not a processing error"""
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = True
+    
+    def unavailable(model):
+        raise ConnectionError('model download failed')
+    
+    processor._get_session = unavailable
+    buffer = io.BytesIO()
+    create_test_subject(60)[0].save(buffer, 'PNG')
+    try:
+        processor.remove_background_bytes(buffer.getvalue(), engine='rembg:u2net')
+        assert False, 'expected EngineUnavailable'
+    except EngineUnavailable as e:
+        assert e.engine == 'rembg:u2net' and 'could not be loaded' in str(e)
+        assert e.state == 'closed'
+    
+    # Without forcing, the same failure falls back to a local engine
+    assert processor.remove_background_bytes(buffer.getvalue()) is not None
+
+def test_forced_skimage_engine_segments_without_scipy_fallback():
+    """Forcing skimage should produce its own mask instead of dropping to the SciPy engine"""
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = False
+    scipy_calls = []
+    processor._scipy_background_removal = lambda image: scipy_calls.append(image) or Image.new('L', image.size, 0)
+    
+    report = {}
+    mask = processor.remove_background_mask(png_bytes(), 'mask', report=report, engine='skimage')
+    assert report['engine'] == 'fallback:skimage'
+    assert scipy_calls == []
+    assert Image.open(io.BytesIO(mask)).getextrema() == (0, 255)
+
+def multipart_body(fields, files, boundary='test-boundary'):
+    """Encode form fields and (filename, bytes) files as multipart/form-data, returning (body, content type)"""
+    body = b''
+    for name, value in fields.items():
+        body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    for name, (filename, data) in files.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + b'\r\n'
+    return body + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+async def asgi_request(bridge, method, path, body=b'', content_type=None, chunk_size=4096, delay=0.0,
+                       declare_length=True):
+    """Drive one HTTP request through an ASGI app, sending the body in chunks; returns (status, headers, body)"""
+    headers = [(b'host', b'test')]
+    if content_type:
+        headers.append((b'content-type', content_type.encode()))
+    if declare_length:
+        headers.append((b'content-length', str(len(body)).encode()))
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': headers,
+             'scheme': 'http', 'http_version': '1.1', 'server': ('test', 80), 'client': ('127.0.0.1', 1234)}
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b'']
+    
+    async def receive():
+        if not chunks:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(delay)
+        data = chunks.pop(0)
+        return {'type': 'http.request', 'body': data, 'more_body': bool(chunks)}
+    
+    messages = []
+    
+    async def send(message):
+        messages.append(message)
+    
+    await bridge(scope, receive, send)
+    start = messages[0]
+    response_headers = {name.decode(): value.decode() for name, value in start['headers']}
+    return start['status'], response_headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+def test_asgi_streams_multipart_uploads_and_enforces_limits():
+    """The ASGI bridge should parse chunked uploads, time them, and refuse oversized ones before dispatch"""
+    load_app()
+    import asgi_app
+    bridge = asgi_app.app
+    body, content_type = multipart_body({'engine': 'fallback:advanced_pil', 'output': 'mask'},
+                                        {'image': ('subject.png', png_bytes())})
+    
+    status, headers, data = asyncio.run(asgi_request(bridge, 'POST', '/remove-background', body, content_type,
+                                                     chunk_size=len(body) // 4 + 1, delay=0.02))
+    assert status == 200 and Image.open(io.BytesIO(data)).mode == 'L'
+    receive_ms = float(headers['server-timing'].split('receive;dur=')[1].split(',')[0])
+    assert receive_ms >= 60
+    
+    dispatched = bridge.dispatched
+    limit = bridge.content_limit('/remove-background')
+    oversized = b'x' * (limit + 1)
+    status, _, data = asyncio.run(asgi_request(bridge, 'POST', '/remove-background', oversized, content_type))
+    assert status == 413 and b'10MB' in data
+    status, _, _ = asyncio.run(asgi_request(bridge, 'POST', '/remove-background', oversized, content_type,
+                                            chunk_size=1024 * 1024, declare_length=False))
+    assert status == 413
+    status, _, _ = asyncio.run(asgi_request(bridge, 'POST', '/remove-background', body[:-20], content_type))
+    assert status == 400
+    assert bridge.dispatched == dispatched
+
+def test_asgi_handler_pool_is_bounded():
+    """Processing requests should never run more than cpu_workers at once, while GETs stay responsive"""
+    load_app()
+    from flask import Flask
+    from asgi_app import AsgiBridge
+    
+    app = Flask('asgi_pool_test')
+    running, peak, lock = [0], [0], threading.Lock()
+    
+    @app.route('/work', methods=['POST'])
+    def work():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return 'done'
+    
+    @app.route('/probe')
+    def probe():
+        return 'ok'
+    
+    bridge = AsgiBridge(app, cpu_workers=2, light_workers=1)
+    
+    async def scenario():
+        work = [asyncio.create_task(asgi_request(bridge, 'POST', '/work')) for _ in range(6)]
+        await asyncio.sleep(0.02)
+        start = time.perf_counter()
+        probe = await asgi_request(bridge, 'GET', '/probe')
+        probe_seconds = time.perf_counter() - start
+        return await asyncio.gather(*work), probe, probe_seconds
+    
+    results, probe, probe_seconds = asyncio.run(scenario())
+    assert [status for status, _, _ in results] == [200] * 6
+    assert peak[0] == 2
+    assert probe[0] == 200 and probe[2] == b'ok' and probe_seconds < 0.1
+
+def test_background_library_cap_holds_for_concurrent_registrations():
+    """A registration that finishes decoding after the library filled up should be refused"""
+    library = BackgroundLibrary(max_backgrounds=1, storage_dir=None)
+    decode = library._decode
+    
+    def decode_while_another_registers(data):
+        # Another upload takes the last slot while this one is being decoded
+        library._decode = decode
+        library.register(png_bytes(40))
+        return decode(data)
+    
+    library._decode = decode_while_another_registers
+    try:
+        library.register(png_bytes(50))
+        assert False, 'expected LibraryFullError'
+    except LibraryFullError:
+        pass
+    assert len(library.list()) == 1
+
+def test_ort_session_options_reach_rembg():
+    """Configured onnxruntime settings and providers should be passed to every session rembg creates"""
+    import onnxruntime as ort
+    from types import SimpleNamespace
+    created = []
+    
+    class FakeSession:
+        def __init__(self, model, sess_opts, **kwargs):
+            created.append((model, sess_opts, kwargs))
+        
+        @classmethod
+        def name(cls):
+            return 'u2netp'
+        
+        @classmethod
+        def download_models(cls, *args, **kwargs):
+            raise AssertionError('local models should not be downloaded')
+    
+    def new_session(model, sess_opts=None, **kwargs):
+        created.append((model, sess_opts, kwargs))
+        return 'downloaded'
+    
+    model_dir = tempfile.mkdtemp()
+    open(os.path.join(model_dir, 'u2netp.int8.onnx'), 'wb').close()
+    processor = MinimalBackgroundRemover(
+        ort_options={'intra_op_threads': 2, 'inter_op_threads': 1, 'graph_optimization': 'basic',
+                     'execution_mode': 'parallel', 'cpu_mem_arena': False,
+                     'providers': ['CPUExecutionProvider']},
+        model_dir=model_dir, model_variants=['int8', 'fp32'])
+    processor.rembg = SimpleNamespace(new_session=new_session, sessions=SimpleNamespace(sessions_class=[FakeSession]))
+    
+    assert processor._get_session('u2net') == 'downloaded'
+    local = processor._get_session('u2netp')
+    assert local.download_models().endswith('u2netp.int8.onnx')
+    assert processor.session_variants == {'u2net': 'download', 'u2netp': 'int8'}
+    
+    for model, sess_opts, kwargs in created:
+        assert kwargs == {'providers': ['CPUExecutionProvider']}
+        assert sess_opts.intra_op_num_threads == 2 and sess_opts.inter_op_num_threads == 1
+        assert sess_opts.graph_optimization_level == ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        assert sess_opts.execution_mode == ort.ExecutionMode.ORT_PARALLEL
+        assert not sess_opts.enable_cpu_mem_arena and sess_opts.enable_mem_pattern
+    assert [model for model, _, _ in created] == ['u2net', 'u2netp']
+    # Sessions are created once per model and reused
+    assert processor._get_session('u2netp') is local and len(created) == 2
+
+def test_inference_pool_round_trips_pixels_and_masks_through_shared_memory():
+    """A mask computed in a pool process should match the one computed in process"""
+    from inference_pool import InferencePool
+    os.environ.setdefault('WARMUP_ON_START', 'false')
+    image = create_test_subject(64)[0].convert('RGBA')
+    local = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    expected, _ = local._segment_native(image.convert('RGB'), 'u2net', engine='fallback:advanced_pil')
+    
+    pool = InferencePool(size=1, threads_per_process=1)
+    try:
+        mask, engine = pool.segment(image, 'u2net', engine='fallback:advanced_pil')
+        assert engine == 'fallback:advanced_pil'
+        assert mask.mode == 'L' and mask.size == image.size
+        assert mask.tobytes() == expected.tobytes()
+        
+        try:
+            pool.segment(image, 'u2net', engine='fallback:unknown')
+            assert False, 'expected the worker error to be re-raised'
+        except ValueError as e:
+            assert 'Unknown segmentation engine' in str(e)
+        stats = pool.stats()
+        assert stats['started'] and stats['completed'] == 1 and stats['failed'] == 1
+    finally:
+        pool.shutdown()
+
+def test_output_format_follows_accept_header_and_alpha():
+    """Negotiation should honour the Accept header and fall back to PNG for alpha and JPEG without"""
+    from image_encoding import negotiate_format, encode_image, available_formats
+    formats = available_formats()
+    
+    assert negotiate_format(None, has_alpha=True) == 'png'
+    assert negotiate_format('*/*', has_alpha=False) == 'jpeg'
+    assert negotiate_format('image/jpeg', has_alpha=True) == 'png'
+    assert negotiate_format('image/png;q=0.5, image/jpeg;q=0.9', has_alpha=False) == 'jpeg'
+    if 'webp' in formats:
+        assert negotiate_format('image/webp,image/*;q=0.8', has_alpha=True) == 'webp'
+        assert negotiate_format('image/webp;q=0, image/png', has_alpha=True) == 'png'
+    if 'avif' in formats and 'webp' in formats:
+        # Equal q-values go to our preference order for the kind of result
+        assert negotiate_format('image/avif,image/webp', has_alpha=False) == 'webp'
+        assert negotiate_format('image/avif,image/webp;q=0.5', has_alpha=False) == 'avif'
+    
+    subject, mask = create_test_subject(40)
+    cutout = subject.convert('RGBA')
+    cutout.putalpha(mask)
+    flattened = Image.open(io.BytesIO(encode_image(cutout, 'jpeg')))
+    assert flattened.format == 'JPEG' and flattened.mode == 'RGB'
+    assert min(flattened.getpixel((0, 0))) > 240
+    assert Image.open(io.BytesIO(encode_image(cutout, 'png'))).getchannel('A').tobytes() == mask.tobytes()
+    if 'webp' in formats:
+        # Transparent WebP is lossless, so the alpha comes back exactly
+        webp = Image.open(io.BytesIO(encode_image(cutout, 'webp')))
+        assert webp.format == 'WEBP' and webp.getchannel('A').tobytes() == mask.tobytes()
+    
+    app_module = load_app()
+    remover = app_module.get_bg_remover()
+    rembg = remover.rembg
+    remover.rembg = False
+    try:
+        client = app_module.app.test_client()
+        post = lambda **data: client.post('/remove-background', data=dict(
+            data, image=(io.BytesIO(png_bytes(48)), 'subject.png')), content_type='multipart/form-data',
+            headers={'Accept': 'image/jpeg,image/png;q=0.9'})
+        transparent = post()
+        assert transparent.mimetype == 'image/png' and transparent.headers['Vary'] == 'Accept'
+        solid = post(background_type='solid', background_color='#00FF00')
+        assert solid.mimetype == 'image/jpeg'
+    finally:
+        remover.rembg = rembg
+
+def test_background_library_registers_dedupes_and_serves_by_id():
+    """Registered backgrounds should dedupe by content, respect the cap and composite by background_id"""
+    app_module = load_app()
+    remover = app_module.get_bg_remover()
+    library = BackgroundLibrary(max_backgrounds=2, storage_dir=None)
+    saved = app_module.background_library, remover.background_library, remover.rembg
+    app_module.background_library = remover.background_library = library
+    remover.rembg = False
+    
+    def background(color):
+        buffer = io.BytesIO()
+        Image.new('RGB', (32, 32), color).save(buffer, 'PNG')
+        return buffer.getvalue()
+    
+    try:
+        client = app_module.app.test_client()
+        register = lambda data: client.post('/backgrounds', data={
+            'background_image': (io.BytesIO(data), 'background.png')}, content_type='multipart/form-data')
+        created = register(background('blue'))
+        assert created.status_code == 201
+        background_id = created.json['background_id']
+        again = register(background('blue'))
+        assert again.status_code == 200 and again.json['background_id'] == background_id
+        assert client.get(f'/backgrounds/{background_id}').json['width'] == 32
+        
+        assert register(background('green')).status_code == 201
+        full = register(background('yellow'))
+        assert full.status_code == 507 and 'full' in full.json['error']
+        try:
+            library.register(background('yellow'))
+            assert False, 'expected LibraryFullError'
+        except LibraryFullError:
+            pass
+        
+        composite = lambda background_id: client.post('/remove-background', data={
+            'image': (io.BytesIO(png_bytes(64)), 'subject.png'), 'background_type': 'image',
+            'background_id': background_id, 'output_format': 'png'}, content_type='multipart/form-data')
+        response = composite(background_id)
+        assert response.status_code == 200
+        result = Image.open(io.BytesIO(response.data)).convert('RGB')
+        assert result.size == (64, 64) and result.getpixel((0, 0)) == (0, 0, 255)
+        assert composite(background_id).status_code == 200
+        stats = library.stats()
+        assert stats['variants'] == 1 and stats['variant_misses'] == 1 and stats['variant_hits'] == 1
+        assert composite('unknown').status_code == 400
+        
+        assert client.delete(f'/backgrounds/{background_id}').status_code == 204
+        assert client.get(f'/backgrounds/{background_id}').status_code == 404
+        assert library.stats()['variants'] == 0
+    finally:
+        app_module.background_library, remover.background_library, remover.rembg = saved
+
+def test_composite_matches_float_blend():
+    """Strip-wise integer compositing should round the exact float blend for every kind of background"""
+    import numpy as np
+    from compositing import composite
+    rng = np.random.default_rng(10)
+    foreground = rng.integers(0, 256, (37, 23, 3), dtype=np.uint8)
+    alpha = rng.integers(0, 256, (37, 23), dtype=np.uint8)
+    alpha[0], alpha[1] = 0, 255
+    background = rng.integers(0, 256, (37, 23, 3), dtype=np.uint8)
+    
+    a = alpha[..., None] / 255.0
+    for bg, bg_pixels in (((12, 200, 99), np.broadcast_to(np.array([12, 200, 99]), background.shape)),
+                          (background, background),
+                          (lambda rows: background[rows], background)):
+        reference = foreground * a + bg_pixels * (1 - a)
+        out = np.zeros_like(foreground)
+        result = composite(foreground, alpha, bg, out=out, strip_height=8)
+        assert result is out and result.dtype == np.uint8
+        assert np.abs(result - reference).max() <= 0.5
+        assert (result[0] == bg_pixels[0]).all() and (result[1] == foreground[1]).all()
+
+def test_tiled_processing_matches_whole_image():
+    """Strip-wise masks, cleanup and compositing should equal the same steps on the whole image"""
+    import numpy as np
+    import minimal_rembg_processor
+    from compositing import composite
+    from tiling import color_distance_mask, clean_mask, composite_tiled
+    rng = np.random.default_rng(14)
+    noise = rng.normal(200, 20, (90, 90, 3)).clip(0, 255).astype(np.uint8)
+    image = create_test_subject(90, Image.fromarray(noise, 'RGB'))[0]
+    height = image.height
+    
+    mask = color_distance_mask(image, strip_height=16)
+    assert mask.dtype == bool and mask.any() and not mask.all()
+    assert (mask == color_distance_mask(image, strip_height=height)).all()
+    cleaned = clean_mask(mask, strip_height=7)
+    assert (cleaned == clean_mask(mask, strip_height=height)).all()
+    
+    alpha = Image.fromarray(cleaned.astype(np.uint8) * 255, 'L')
+    background = Image.fromarray(rng.integers(0, 256, (height, 90, 3), dtype=np.uint8), 'RGB')
+    whole = composite(np.asarray(image), np.asarray(alpha), np.asarray(background))
+    for bg in ((0, 128, 255), background):
+        tiled = composite_tiled(image, alpha, bg, strip_height=16)
+        expected = composite(np.asarray(image), np.asarray(alpha), bg) if isinstance(bg, tuple) else whole
+        assert (np.asarray(tiled) == expected).all()
+    
+    # Images over MAX_IMAGE_PIXELS are refused with 413 before any pixels are decoded
+    app_module = load_app()
+    limit = minimal_rembg_processor.MAX_IMAGE_PIXELS
+    minimal_rembg_processor.MAX_IMAGE_PIXELS = 1000
+    try:
+        response = app_module.app.test_client().post('/remove-background', data={
+            'image': (io.BytesIO(png_bytes(48)), 'subject.png')}, content_type='multipart/form-data')
+        assert response.status_code == 413 and '48x48' in response.json['error']
+    finally:
+        minimal_rembg_processor.MAX_IMAGE_PIXELS = limit
+
+def test_quality_tiers_and_latency_budget_choose_the_plan():
+    """Tiers should start at their own rung and a latency budget should walk down to the first that fits"""
+    from engine_selection import (choose_plan, predict_plan_seconds, ThroughputTracker, REMBG_LADDER,
+                                  QUALITY_TIERS)
+    tracker = ThroughputTracker()
+    name = lambda model: f"rembg:{model}"
+    size = (4000, 3000)
+    
+    for tier in QUALITY_TIERS:
+        first = next(rung for rung in REMBG_LADDER if rung[0] == tier)
+        plan = choose_plan(size, REMBG_LADDER, name, tracker, tier)
+        assert (plan['tier'], plan['engine'], plan['proxy_edge']) == first
+    assert choose_plan(size, REMBG_LADDER, name, tracker)['engine'] == 'isnet-general-use'
+    
+    predicted = [predict_plan_seconds(tracker, name(model), size, edge) * 1000 for _, model, edge in REMBG_LADDER]
+    budget = (predicted[0] + predicted[-1]) / 2
+    plan = choose_plan(size, REMBG_LADDER, name, tracker, 'best', max_latency_ms=budget)
+    index = next(i for i, ms in enumerate(predicted) if ms <= budget)
+    assert 0 < index and (plan['engine'], plan['proxy_edge']) == REMBG_LADDER[index][1:]
+    assert plan['predicted_ms'] <= budget
+    # Nothing fits: the fastest rung
+    plan = choose_plan(size, REMBG_LADDER, name, tracker, 'best', max_latency_ms=1)
+    assert (plan['tier'], plan['engine'], plan['proxy_edge']) == REMBG_LADDER[-1]
+    
+    # Measurements on this host scale the predictions for every size
+    seconds = tracker.predict('rembg:isnet-general-use', 1_000_000)
+    for _ in range(3):
+        tracker.record('rembg:isnet-general-use', 1_000_000, 10 * seconds)
+    slow = predict_plan_seconds(tracker, 'rembg:isnet-general-use', size, 0) * 1000
+    assert abs(slow - 10 * predicted[0]) < 1
+    
+    # Without rembg, plans come from the local engines
+    processor = MinimalBackgroundRemover(mask_cache=MaskCache(max_bytes=0))
+    processor.rembg = False
+    plan = processor.plan_segmentation((800, 600), 'fast')
+    assert plan['tier'] == 'fast' and plan['fallback_engine'] == 'advanced_pil' and plan['proxy_edge'] == 512
+    report = {}
+    processor.remove_background_bytes(png_bytes(64), quality_tier='fast', report=report)
+    assert report['plan']['tier'] == 'fast' and report['engine'].startswith('fallback:advanced_pil')
+
+def test_ladders_and_benchmark_priors():
+    """Ladders should only name known engines, and benchmark results should fit per-engine cost priors"""
+    import json
+    from minimal_rembg_processor import SUPPORTED_MODELS, FALLBACK_ENGINES
+    from engine_selection import (load_benchmark_priors, ThroughputTracker, REMBG_LADDER, FALLBACK_LADDER,
+                                  QUALITY_TIERS, ENGINE_COST_PRIORS)
+    for ladder, engines in ((REMBG_LADDER, SUPPORTED_MODELS), (FALLBACK_LADDER, FALLBACK_ENGINES)):
+        ranks = [QUALITY_TIERS.index(tier) for tier, _, _ in ladder]
+        assert ranks == sorted(ranks) and set(ranks) == {0, 1, 2}
+        assert all(engine in engines and edge >= 0 for _, engine, edge in ladder)
+    
+    results = [
+        {'engine': 'opencv', 'dimensions': [1000, 1000], 'p50_ms': 1000.0},
+        {'engine': 'opencv', 'dimensions': [2000, 2000], 'p50_ms': 2500.0},
+        {'engine': 'rembg:u2net', 'dimensions': [1000, 1000], 'p50_ms': 700.0},
+        {'engine': 'scipy', 'dimensions': [1000, 1000], 'error': 'failed'},
+    ]
+    path = os.path.join(tempfile.mkdtemp(), 'bench.json')
+    with open(path, 'w') as f:
+        json.dump({'results': results}, f)
+    priors = load_benchmark_priors(path)
+    assert set(priors) == {'fallback:opencv', 'rembg:u2net'}
+    fixed, per_megapixel = priors['fallback:opencv']
+    assert abs(fixed - 0.5) < 1e-9 and abs(per_megapixel - 0.5) < 1e-9
+    # A single size keeps the default fixed cost and attributes the rest to pixels
+    fixed, per_megapixel = priors['rembg:u2net']
+    assert fixed == ENGINE_COST_PRIORS['rembg:u2net'][0] and abs(per_megapixel - 0.1) < 1e-9
+    
+    tracker = ThroughputTracker(priors)
+    assert abs(tracker.predict('fallback:opencv', 3_000_000) - 2.0) < 1e-9
+    assert tracker.prior('fallback:advanced_pil') == ENGINE_COST_PRIORS['fallback:advanced_pil']
+
+def test_backend_registry_remembers_import_failures():
+    """A backend that fails to import should be reported unavailable, with its error, without retrying"""
+    import sys
+    import subprocess
+    from backends import BackendRegistry
+    package_dir = tempfile.mkdtemp()
+    broken_path = os.path.join(package_dir, 'bgtest_broken_backend.py')
+    with open(broken_path, 'w') as f:
+        f.write("raise ImportError('libGL.so.1: cannot open shared object file')\n")
+    sys.path.insert(0, package_dir)
+    try:
+        registry = BackendRegistry({'broken': ('bgtest_broken_backend',), 'good': ('json',),
+                                    'missing': ('bgtest_not_installed',)})
+        assert registry.installed('broken') and registry.available('broken')
+        try:
+            registry.load('broken')
+            assert False, 'expected ImportError'
+        except ImportError as e:
+            assert 'libGL' in str(e)
+        assert not registry.available('broken') and registry.optional('broken') is None
+        # The failure is remembered rather than imported again
+        os.remove(broken_path)
+        try:
+            registry.load('broken')
+            assert False, 'expected ImportError'
+        except ImportError as e:
+            assert 'libGL' in str(e)
+        
+        assert registry.optional('missing') is None
+        registry.warm_up('good, unknown')
+        assert registry.loaded('good') and registry.load('good').__name__ == 'json'
+        report = registry.report()
+        assert report['good']['loaded'] and report['good']['import_ms'] is not None
+        assert report['broken']['installed'] and not report['broken']['loaded']
+        assert report['broken']['error'] == 'ImportError: libGL.so.1: cannot open shared object file'
+        assert report['missing'] == {'installed': False, 'loaded': False, 'import_ms': None, 'error': None}
+    finally:
+        sys.path.remove(package_dir)
+    
+    # Importing the processor leaves the optional libraries for first use
+    imported = subprocess.run(
+        [sys.executable, '-c', "import sys, minimal_rembg_processor; "
+         "print(sorted(m for m in ('cv2', 'skimage', 'scipy.ndimage', 'rembg', 'onnxruntime') if m in sys.modules))"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert imported.stdout.strip() == '[]'
+
 if __name__ == "__main__":
     print("🚀 Background Removal API Test")
     print("=" * 50)
     
-    success = test_background_removal()
+    try:
+        test_background_removal()
+        success = True
+    except Exception as e:
+        print(f"❌ Test failed with error: {e}")
+        success = False
     
     print("=" * 50)
     if success:
@@ -0,0 +1,148 @@
+import os
+import math
+import logging
+
+import numpy as np
+from PIL import Image
+
+from compositing import composite, tint_pixels
+from backends import BACKENDS
+
+logger = logging.getLogger(__name__)
+
+# Rows processed per strip in tiled mode
+TILE_STRIP_HEIGHT = int(os.environ.get('TILE_STRIP_HEIGHT', 512))
+
+# Images with more pixels than this run the per-pixel stages strip by strip (0 = always)
+TILED_PROCESSING_PIXELS = int(os.environ.get('TILED_PROCESSING_PIXELS', 16_000_000))
+
+def use_tiled(size, threshold=TILED_PROCESSING_PIXELS):
+    """Whether an image of this (width, height) should be processed in strips"""
+    return size[0] * size[1] > threshold
+
+
+def strips(height, strip_height=TILE_STRIP_HEIGHT, halo=0):
+    """
+    Yield (top, bottom, read_top, read_bottom) row ranges covering height
+
+    Each strip writes rows top:bottom and reads read_top:read_bottom, which
+    extends it by halo rows on both sides (clipped to the image) so
+    neighbourhood operations see the same context as on the whole image.
+    """
+    strip_height = max(1, strip_height)
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        yield top, bottom, max(0, top - halo), min(height, bottom + halo)
+
+
+def _strip_pixels(image, top, bottom):
+    """RGB uint8 array of rows top:bottom of a PIL image"""
+    strip = image.crop((0, top, image.width, bottom))
+    if strip.mode != 'RGB':
+        strip = strip.convert('RGB')
+    return np.asarray(strip)
+
+
+def _border_color(image):
+    """Mean color of the outermost rows and columns, read without a full-size copy"""
+    width, height = image.size
+    edges = [
+        _strip_pixels(image, 0, 1).reshape(-1, 3),
+        _strip_pixels(image, height - 1, height).reshape(-1, 3),
+        np.asarray(image.crop((0, 0, 1, height)).convert('RGB')).reshape(-1, 3),
+        np.asarray(image.crop((width - 1, 0, width, height)).convert('RGB')).reshape(-1, 3),
+    ]
+    return np.concatenate(edges).mean(axis=0)
+
+
+def _color_distance(pixels, color):
+    diff = pixels.astype(np.float32)
+    diff -= color.astype(np.float32)
+    diff *= diff
+    return np.sqrt(diff.sum(axis=2))
+
+
+def color_distance_mask(image, strip_height=TILE_STRIP_HEIGHT):
+    """
+    Tiled version of the color-distance segmentation: True where a pixel differs from the border color
+
+    The threshold is mean + 0.5 * std of the distance over the whole image,
+    gathered in a first pass, so the distance map is never held in full; the
+    second pass recomputes it per strip and thresholds into a bool mask.
+    """
+    width, height = image.size
+    background = _border_color(image)
+
+    total = 0.0
+    total_sq = 0.0
+    for top, bottom, _, _ in strips(height, strip_height):
+        distance = _color_distance(_strip_pixels(image, top, bottom), background)
+        total += float(distance.sum(dtype=np.float64))
+        total_sq += float(np.square(distance, dtype=np.float64).sum())
+    count = width * height
+    mean = total / count
+    threshold = mean + math.sqrt(max(total_sq / count - mean * mean, 0.0)) * 0.5
+
+    mask = np.empty((height, width), dtype=bool)
+    for top, bottom, _, _ in strips(height, strip_height):
+        mask[top:bottom] = _color_distance(_strip_pixels(image, top, bottom), background) > threshold
+    return mask
+
+
+def filter_tiled(mask, operation, halo, strip_height=TILE_STRIP_HEIGHT):
+    """
+    Apply a neighbourhood operation to a 2-D array strip by strip
+
+    halo must be at least the number of rows the operation can propagate
+    (for binary opening/closing with a 3x3 element, twice the iterations),
+    so every written row matches the whole-image result.
+    """
+    out = np.empty_like(mask)
+    for top, bottom, read_top, read_bottom in strips(mask.shape[0], strip_height, halo):
+        filtered = operation(mask[read_top:read_bottom])
+        out[top:bottom] = filtered[top - read_top:bottom - read_top]
+    return out
+
+
+def clean_mask(mask, opening=1, closing=2, strip_height=TILE_STRIP_HEIGHT):
+    """Binary opening then closing, as the fallback engines do, with overlap halos"""
+    ndimage = BACKENDS.optional('scipy')
+    if ndimage is None:
+        return mask
+
+    def operation(block):
+        block = ndimage.binary_opening(block, iterations=opening)
+        return ndimage.binary_closing(block, iterations=closing)
+
+    return filter_tiled(mask, operation, 2 * (opening + closing), strip_height)
+
+
+def composite_tiled(rgb_image, mask, background, strip_height=TILE_STRIP_HEIGHT):
+    """
+    Composite a PIL subject over a background one strip at a time into a new RGB image
+
+    background is an (r, g, b) tuple, a PIL image or RGB array the size of
+    the subject, or a callable mapping a subject strip to its background
+    strip. Only the result image is full size.
+    """
+    width, height = rgb_image.size
+    result = Image.new('RGB', (width, height))
+    for top, bottom, _, _ in strips(height, strip_height):
+        foreground = np.array(_strip_pixels(rgb_image, top, bottom))
+        alpha = np.asarray(mask.crop((0, top, width, bottom)))
+        if isinstance(background, tuple):
+            strip = background
+        elif isinstance(background, Image.Image):
+            strip = _strip_pixels(background, top, bottom)
+        elif callable(background):
+            strip = background(foreground)
+        else:
+            strip = background[top:bottom]
+        composite(foreground, alpha, strip, out=foreground)
+        result.paste(Image.fromarray(foreground, 'RGB'), (0, top))
+    return result
+
+
+def tint_strip(color, strength):
+    """Background callable for composite_tiled that tints each subject strip"""
+    return lambda foreground: tint_pixels(foreground, color, strength)
@@ -0,0 +1,188 @@
+import os
+import io
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Optional statistical profiler; cProfile is always there as a fallback
+try:
+    import pyinstrument
+    PYINSTRUMENT_AVAILABLE = True
+except ImportError:
+    pyinstrument = None
+    PYINSTRUMENT_AVAILABLE = False
+
+import cProfile
+import pstats
+
+# Requests slower than this (seconds) log their full stage breakdown as a warning
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 5))
+
+# Profile one in every N processing requests (0 = off) with cProfile or pyinstrument
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', 0))
+PROFILER = os.environ.get('PROFILER', 'cprofile').lower()
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'bgremoval-profiles')
+
+
+class StageTimer:
+    """
+    Wall-clock durations of named processing stages, in the order first seen
+
+    Entering the same stage again adds to its total, so batch requests report
+    the time spent in each stage across all images. A stage can carry a
+    description, such as the engine that ran the segmentation.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.descriptions = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def total(self):
+        return sum(self.durations.values())
+
+    def to_dict(self):
+        """Stage durations in milliseconds"""
+        return {name: round(seconds * 1000, 2) for name, seconds in self.durations.items()}
+
+    def server_timing(self, total=None):
+        """Value for the Server-Timing response header"""
+        entries = []
+        for name, seconds in self.durations.items():
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if name in self.descriptions:
+                entry += f';desc="{self.descriptions[name]}"'
+            entries.append(entry)
+        if total is not None:
+            entries.append(f"total;dur={total * 1000:.1f}")
+        return ', '.join(entries)
+
+
+class _NullTimer:
+    """Stand-in used when the caller did not ask for timings"""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add(self, name, seconds):
+        pass
+
+    def describe(self, name, description):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def log_timings(event, timer, total=None, slow_threshold=SLOW_REQUEST_SECONDS, **fields):
+    """
+    Emit one structured log line with the stage breakdown
+
+    When total exceeds slow_threshold the same record is logged as a warning,
+    so slow requests stand out with their full breakdown and dimensions.
+    """
+    total = timer.total() if total is None else total
+    record = {'event': event, 'total_ms': round(total * 1000, 2), 'stages_ms': timer.to_dict()}
+    if timer.descriptions:
+        record['stage_info'] = dict(timer.descriptions)
+    record.update(fields)
+    if slow_threshold and total > slow_threshold:
+        record['slow'] = True
+        logger.warning(f"Slow request: {json.dumps(record, default=str)}")
+    else:
+        logger.info(json.dumps(record, default=str))
+
+
+def report_timer(report):
+    """Return the StageTimer kept in a report dict, creating it, or a no-op timer without one"""
+    if report is None:
+        return NULL_TIMER
+    timer = report.get('timings')
+    if timer is None:
+        timer = report['timings'] = StageTimer()
+    return timer
+
+
+class ProfileSampler:
+    """
+    Profile one in every N calls and write each profile under output_dir
+
+    cProfile output is a pstats file (open with snakeviz or pstats); with
+    PROFILER=pyinstrument and pyinstrument installed, an HTML report.
+    """
+
+    def __init__(self, every=PROFILE_SAMPLE_EVERY, profiler=PROFILER, output_dir=PROFILE_DIR):
+        self.every = every
+        self.profiler = 'pyinstrument' if profiler == 'pyinstrument' and PYINSTRUMENT_AVAILABLE else 'cprofile'
+        self.output_dir = output_dir
+        self._count = 0
+        self._lock = threading.Lock()
+        if profiler == 'pyinstrument' and not PYINSTRUMENT_AVAILABLE:
+            logger.warning("pyinstrument not installed, profiling with cProfile")
+
+    @property
+    def enabled(self):
+        return self.every > 0
+
+    def start(self):
+        """Start a profiler if this call is sampled; returns it, or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._count += 1
+            if self._count % self.every:
+                return None
+        try:
+            if self.profiler == 'pyinstrument':
+                profiler = pyinstrument.Profiler()
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            return profiler
+        except Exception as e:
+            # Only one profiler can be active per interpreter on newer Pythons
+            logger.warning(f"Could not start profiler: {e}")
+            return None
+
+    def stop(self, profiler, label):
+        """Stop a profiler returned by start and write its report; returns the path"""
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{label}-{self._count}"
+            if self.profiler == 'pyinstrument':
+                profiler.stop()
+                path = os.path.join(self.output_dir, f"{name}.html")
+                with open(path, 'w') as f:
+                    f.write(profiler.output_html())
+            else:
+                profiler.disable()
+                path = os.path.join(self.output_dir, f"{name}.prof")
+                profiler.dump_stats(path)
+                summary = io.StringIO()
+                pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+                logger.debug(summary.getvalue())
+            logger.info(f"Wrote request profile to {path}")
+            return path
+        except Exception as e:
+            logger.warning(f"Failed to write profile: {e}")
+            return None